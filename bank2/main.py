@@ -1,11 +1,25 @@
 from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional, List
-from datetime import datetime, timedelta
+from typing import Optional, List, Tuple
+from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+import anyio
+import asyncio
 import bcrypt
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
 import uuid
 
 app = FastAPI(title="Bank 2 API", version="3.0")
@@ -19,16 +33,137 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Metrics: Prometheus-style latency histograms, exposed on /metrics.
+# Observations are only made on the event loop, so they need no locking.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per tuple of label values"""
+
+    def __init__(self, name: str, description: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, seconds: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for labels, series in list(self._series.items()):
+            label_text = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, labels))
+            bucket_prefix = label_text + "," if label_text else ""
+            total = 0
+            for bound, count in zip(bounds, series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{bucket_prefix}le="{bound}"}} {total}')
+            series_labels = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{series_labels} {series[-1]}")
+            lines.append(f"{self.name}_count{series_labels} {total}")
+        return lines
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Histogram] = []
+
+    def histogram(self, name: str, description: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, description, labelnames, buckets)
+        self._metrics.append(histogram)
+        return histogram
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request",
+    ("method", "route", "status")
+)
+
+class RequestMetricsMiddleware:
+    """Plain ASGI middleware (cheaper than @app.middleware) timing every request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template, not the raw path, keeps path parameters out of the labels
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status_code)
+            )
+
+app.add_middleware(RequestMetricsMiddleware)
+
 # Security
 SECRET_KEY = "bank2_secret_key_change_in_production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+ACCOUNT_LOCK_SHARDS = int(os.getenv("ACCOUNT_LOCK_SHARDS", "64"))
+# Sync handlers run on this many worker threads (Starlette's default is 40)
+BANK_THREADPOOL_SIZE = int(os.getenv("BANK_THREADPOOL_SIZE", "200"))
+
+# Password hashing runs on its own executor so login/register bursts
+# cannot occupy the threadpool that serves gateway debit/credit calls
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+PASSWORD_HASH_USE_PROCESSES = os.getenv("PASSWORD_HASH_USE_PROCESSES", "false").lower() in ("1", "true", "yes")
+
+# Precomputed bcrypt hashes of the demo passwords, so startup does no hashing
+SAMPLE_PASSWORD_HASHES = {
+    "password123": "$2b$12$9pzYH/CtZHt5CbzzC8k5JuI3C7qa8pkD4wsSSZFr0zRskC9XzIuLq",
+    "shopstore123": "$2b$12$IWHVP1Ekg/EFu8BjTdgVfuwDC/AK7.onyxb2qd3Vrk1NWVc3W9Faa",
+}
+
+# Ledger persistence: "memory" (nothing survives a restart), "sqlite" or "log"
+BANK_STORAGE = os.getenv("BANK_STORAGE", "memory").lower()
+BANK_STORAGE_PATH = os.getenv("BANK_STORAGE_PATH", "bank2_ledger.sqlite3" if BANK_STORAGE == "sqlite" else "bank2_ledger.jsonl")
+BANK_STORAGE_FSYNC = os.getenv("BANK_STORAGE_FSYNC", "true").lower() in ("1", "true", "yes")
+BANK_STORAGE_MAX_BATCH = int(os.getenv("BANK_STORAGE_MAX_BATCH", "1024"))
+
+DEFAULT_HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+HOLD_EXPIRE_SECONDS = 60
 
 security = HTTPBearer()
 
 # In-memory database
 users_db = {}
+accounts_db = {}  # account_number -> same record as in users_db
 transactions_db = []
+applied_transactions = {}  # (type, transaction_id) -> transaction, to skip (or reject mismatched) gateway retries
+holds_db = {}       # hold_id -> hold
+account_holds = {}  # account_number -> {hold_id: hold}
 
 # Models
 class User(BaseModel):
@@ -67,6 +202,439 @@ class AuthorizeTransferRequest(BaseModel):
     amount: float
     token: str
 
+class PrepareTransferRequest(BaseModel):
+    from_account: str
+    amount: float
+    token: str
+
+class InternalTransferRequest(BaseModel):
+    from_account: str
+    to_account: str
+    amount: float
+    token: str
+    transaction_id: str
+
+class LedgerEntryRequest(BaseModel):
+    account_number: str
+    amount: float
+    transaction_id: str
+    hold_id: Optional[str] = None
+
+class BulkVerifyAccountsRequest(BaseModel):
+    account_numbers: List[str]
+
+class BulkPrepareTransferRequest(BaseModel):
+    transfers: List[PrepareTransferRequest]
+
+class BulkInternalTransferRequest(BaseModel):
+    transfers: List[InternalTransferRequest]
+
+class BulkLedgerRequest(BaseModel):
+    entries: List[LedgerEntryRequest]
+
+class BulkReleaseHoldRequest(BaseModel):
+    hold_ids: List[str]
+
+class AccountHistory:
+    """Time-ordered transactions of one account, with a parallel list of timestamps for bisect"""
+
+    def __init__(self):
+        self.transactions = []
+        self.timestamps = []
+
+    def append(self, transaction: dict, timestamp: datetime):
+        # Keep the timestamp list sorted even if the clock steps backwards
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            timestamp = self.timestamps[-1]
+        self.transactions.append(transaction)
+        self.timestamps.append(timestamp)
+
+    def page(self, limit: int, cursor: Optional[int] = None, since: Optional[datetime] = None, until: Optional[datetime] = None):
+        """Newest-first page; returns (transactions, next_cursor)"""
+        lo = bisect_left(self.timestamps, since) if since else 0
+        hi = bisect_right(self.timestamps, until) if until else len(self.timestamps)
+        if cursor is not None:
+            hi = min(hi, cursor)
+        start = max(lo, hi - limit)
+        page = self.transactions[start:hi][::-1]
+        return page, (start if start > lo else None)
+
+account_histories = {}  # account_number -> AccountHistory
+
+class AccountLockManager:
+    """
+    One lock per account, kept in shards so creating a lock never
+    serializes the whole bank. Balances and holds of an account are only
+    changed while its lock is held; locked() takes several accounts'
+    locks in sorted order so two-account transfers cannot deadlock.
+    """
+
+    def __init__(self, shards: int):
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+
+    def lock_for(self, account_number: str) -> threading.Lock:
+        guard, locks = self._shards[hash(account_number) % len(self._shards)]
+        lock = locks.get(account_number)
+        if lock is None:
+            with guard:
+                lock = locks.setdefault(account_number, threading.Lock())
+        return lock
+
+    @contextmanager
+    def locked(self, *account_numbers: str):
+        locks = [self.lock_for(a) for a in sorted(set(account_numbers))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+account_locks = AccountLockManager(ACCOUNT_LOCK_SHARDS)
+
+class TokenCache:
+    """
+    Bounded LRU of already-verified JWTs: token -> (subject, exp).
+    
+    Entries are dropped once their exp passes, so a cached token never
+    outlives the JWT itself. Revoked tokens are rejected until they expire.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._expiry_heap = []  # (exp, token), may hold stale items
+        self._revoked = {}  # token -> exp
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.decode_cpu_seconds = 0.0
+
+    def _evict_expired(self, now: float):
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            exp, token = heapq.heappop(self._expiry_heap)
+            entry = self._entries.get(token)
+            if entry and entry[1] == exp:
+                del self._entries[token]
+            if self._revoked.get(token) == exp:
+                del self._revoked[token]
+
+    def get(self, token: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return {"sub": entry[0], "exp": entry[1]}
+
+    def put(self, token: str, subject: Optional[str], exp: float, decode_cpu_seconds: float):
+        with self._lock:
+            self.decode_cpu_seconds += decode_cpu_seconds
+            self._entries[token] = (subject, exp)
+            self._entries.move_to_end(token)
+            heapq.heappush(self._expiry_heap, (exp, token))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if len(self._expiry_heap) > 2 * self.max_size + len(self._revoked):
+                self._expiry_heap = [(e[1], t) for t, e in self._entries.items()]
+                self._expiry_heap.extend((e, t) for t, e in self._revoked.items())
+                heapq.heapify(self._expiry_heap)
+
+    def is_revoked(self, token: str) -> bool:
+        return token in self._revoked
+
+    def invalidate(self, token: str, exp: Optional[float] = None):
+        """Forget a token; with exp, also reject it until it expires (logout)"""
+        with self._lock:
+            self._entries.pop(token, None)
+            if exp is not None:
+                self._revoked[token] = exp
+                heapq.heappush(self._expiry_heap, (exp, token))
+
+    def clear(self):
+        """Drop every cached token, e.g. after rotating SECRET_KEY"""
+        with self._lock:
+            self._entries.clear()
+            self._expiry_heap = [(e, t) for t, e in self._revoked.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        avg_decode = self.decode_cpu_seconds / self.misses if self.misses else 0.0
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "revoked": len(self._revoked),
+            "avg_decode_cpu_ms": avg_decode * 1000,
+            "cpu_seconds_saved": self.hits * avg_decode
+        }
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a dedicated bounded executor (threads, or processes).
+    
+    At most max_pending calls may be queued or running; beyond that
+    callers get 503 with Retry-After instead of piling up.
+    """
+
+    def __init__(self, workers: int, max_pending: int, use_processes: bool):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, fn, *args):
+        # Only touched from the event loop, so no lock is needed
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many authentication requests, please retry",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self.run(get_password_hash, password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_USE_PROCESSES)
+
+class CommitTicket:
+    """Handed back by LedgerStore.write(); wait() returns once the record is durable"""
+
+    def __init__(self, done: bool = False):
+        self._event = threading.Event()
+        self.error = None
+        if done:
+            self._event.set()
+
+    def resolve(self, error: Optional[Exception] = None):
+        self.error = error
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        if self.error:
+            raise self.error
+
+# Shared ticket for writes that have nothing to wait for
+COMMITTED = CommitTicket(done=True)
+
+class LedgerStore:
+    """
+    Ledger persistence interface. Records are plain dicts:
+      {"op": "user", "user": {...}}
+      {"op": "txn", "transaction": {...}, "balances": {account_number: balance}}
+    This base class keeps nothing, which is the in-memory default.
+    """
+    durable = False
+
+    def load(self):
+        """Yield stored records in write order"""
+        return iter(())
+
+    def write(self, record: dict) -> CommitTicket:
+        return COMMITTED
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": BANK_STORAGE, "durable": self.durable}
+
+class GroupCommitStore(LedgerStore, ABC):
+    """
+    Base for durable stores. write() only queues the record; a single
+    committer thread drains everything queued so far and persists it with
+    one commit/fsync, so concurrent transfers share the cost of a sync.
+    """
+    durable = True
+
+    def __init__(self, max_batch: int):
+        self.max_batch = max_batch
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self.commits = 0
+        self.records = 0
+        self._thread = threading.Thread(target=self._run, name="ledger-commit", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict) -> CommitTicket:
+        ticket = CommitTicket()
+        # Serialize now: the caller may keep mutating the dicts after we return
+        line = json.dumps(record)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Ledger store is closed")
+            self._pending.append((record, line, ticket))
+            self._cond.notify()
+        return ticket
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            error = None
+            try:
+                self._commit(batch)
+                self.commits += 1
+                self.records += len(batch)
+            except Exception as e:
+                print(f"❌ Ledger commit failed: {e}")
+                error = e
+            for _, _, ticket in batch:
+                ticket.resolve(error)
+
+    @abstractmethod
+    def _commit(self, batch: list):
+        """Persist a batch of (record, line, ticket) atomically, or raise"""
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "backend": BANK_STORAGE,
+            "durable": self.durable,
+            "commits": self.commits,
+            "records": self.records,
+            "avg_records_per_commit": self.records / self.commits if self.commits else 0.0,
+            "pending": len(self._pending)
+        }
+
+class LogLedgerStore(GroupCommitStore):
+    """Append-only JSON-lines file, fsynced once per group commit"""
+
+    def __init__(self, path: str, fsync: bool, max_batch: int):
+        self.path = path
+        self.fsync = fsync
+        self._file = open(path, "a", encoding="utf-8")
+        super().__init__(max_batch)
+
+    def load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn final write from a crash; it was never acknowledged
+                    print("⚠️ Ignoring incomplete ledger record at end of log")
+                    return
+
+    def _commit(self, batch: list):
+        self._file.write("".join(line + "\n" for _, line, _ in batch))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        super().close()
+        self._file.close()
+
+class SQLiteLedgerStore(GroupCommitStore):
+    """SQLite in WAL mode; each group commit is one transaction"""
+
+    def __init__(self, path: str, fsync: bool, max_batch: int):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={'FULL' if fsync else 'OFF'}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "account_number TEXT PRIMARY KEY, username TEXT UNIQUE, record TEXT, balance REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transactions (seq INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT)"
+        )
+        super().__init__(max_batch)
+
+    def load(self):
+        for record, balance in self._conn.execute("SELECT record, balance FROM users ORDER BY rowid"):
+            user = json.loads(record)
+            user["balance"] = balance
+            yield {"op": "user", "user": user}
+        for (record,) in self._conn.execute("SELECT record FROM transactions ORDER BY seq"):
+            yield {"op": "txn", "transaction": json.loads(record), "balances": {}}
+
+    def _commit(self, batch: list):
+        cur = self._conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            for record, line, _ in batch:
+                if record["op"] == "user":
+                    # Use the snapshot taken at write(), not the live (since mutated) dict
+                    user = json.loads(line)["user"]
+                    cur.execute(
+                        "INSERT OR REPLACE INTO users (account_number, username, record, balance) VALUES (?, ?, ?, ?)",
+                        (user["account_number"], user["username"], json.dumps(user), user["balance"])
+                    )
+                elif record["op"] == "txn":
+                    cur.execute("INSERT INTO transactions (record) VALUES (?)", (json.dumps(record["transaction"]),))
+                    cur.executemany(
+                        "UPDATE users SET balance = ? WHERE account_number = ?",
+                        [(balance, account) for account, balance in record["balances"].items()]
+                    )
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        super().close()
+        self._conn.close()
+
+def open_ledger_store() -> LedgerStore:
+    if BANK_STORAGE == "sqlite":
+        return SQLiteLedgerStore(BANK_STORAGE_PATH, BANK_STORAGE_FSYNC, BANK_STORAGE_MAX_BATCH)
+    if BANK_STORAGE == "log":
+        return LogLedgerStore(BANK_STORAGE_PATH, BANK_STORAGE_FSYNC, BANK_STORAGE_MAX_BATCH)
+    if BANK_STORAGE != "memory":
+        raise ValueError(f"Unknown BANK_STORAGE '{BANK_STORAGE}', expected memory, sqlite or log")
+    return LedgerStore()
+
+ledger_store = open_ledger_store()
+
 # Helper functions
 def verify_password(plain_password, hashed_password):
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
@@ -81,10 +649,24 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def decode_token(token: str) -> dict:
+    """jwt.decode behind token_cache; returns sub and exp, raises JWTError"""
+    if token_cache.is_revoked(token):
+        raise JWTError("Token has been revoked")
+    cached = token_cache.get(token)
+    if cached:
+        return cached
+    start = time.thread_time()
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    claims = {"sub": payload.get("sub"), "exp": payload.get("exp")}
+    if claims["exp"] is not None:
+        token_cache.put(token, claims["sub"], float(claims["exp"]), time.thread_time() - start)
+    return claims
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -92,6 +674,86 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def add_user(user: dict, persist: bool = True) -> CommitTicket:
+    """Store a user record and index it by account number"""
+    users_db[user["username"]] = user
+    accounts_db[user["account_number"]] = user
+    if not persist:
+        return COMMITTED
+    return ledger_store.write({"op": "user", "user": user})
+
+def get_user_by_account(account_number: str) -> Optional[dict]:
+    return accounts_db.get(account_number)
+
+def record_transaction(transaction: dict, balances: dict) -> CommitTicket:
+    """
+    Apply a ledger entry in memory and queue it for persistence along with
+    the resulting balances. Call under the accounts' locks, then wait() on
+    the ticket after releasing them.
+    """
+    index_transaction(transaction)
+    return ledger_store.write({"op": "txn", "transaction": transaction, "balances": balances})
+
+def retry_conflict(applied: dict, from_account: str, to_account: str, amount: float) -> Optional[dict]:
+    """
+    A transaction id seen before must repeat the entry it was applied
+    with; returns the failure to report if the accounts or amount differ
+    """
+    if (applied["from_account"], applied["to_account"], applied["amount"]) == (from_account, to_account, amount):
+        return None
+    return {
+        "success": False,
+        "error": "transaction_id_conflict",
+        "reason": "Transaction id was already used for a different transfer"
+    }
+
+def index_transaction(transaction: dict):
+    """Append to the ledger and to the history of every local account involved"""
+    transactions_db.append(transaction)
+    applied_transactions[(transaction["type"], transaction["transaction_id"])] = transaction
+    timestamp = datetime.fromisoformat(transaction["timestamp"])
+    for account_number in {transaction["from_account"], transaction["to_account"]}:
+        if account_number in accounts_db:
+            history = account_histories.get(account_number)
+            if history is None:
+                history = account_histories[account_number] = AccountHistory()
+            history.append(transaction, timestamp)
+
+# The hold helpers below expect the caller to hold the account's lock
+def add_hold(account_number: str, amount: float) -> dict:
+    hold = {
+        "hold_id": str(uuid.uuid4()),
+        "account_number": account_number,
+        "amount": amount,
+        "expires_at": datetime.utcnow() + timedelta(seconds=HOLD_EXPIRE_SECONDS)
+    }
+    holds_db[hold["hold_id"]] = hold
+    account_holds.setdefault(account_number, {})[hold["hold_id"]] = hold
+    return hold
+
+def release_hold(hold_id: str) -> Optional[dict]:
+    hold = holds_db.pop(hold_id, None)
+    if hold:
+        holds = account_holds.get(hold["account_number"], {})
+        holds.pop(hold_id, None)
+        if not holds:
+            account_holds.pop(hold["account_number"], None)
+    return hold
+
+def held_amount(account_number: str) -> float:
+    """Funds on hold for an account; expired holds are released on the way"""
+    holds = account_holds.get(account_number)
+    if not holds:
+        return 0.0
+    now = datetime.utcnow()
+    for hold_id in [h for h, hold in holds.items() if hold["expires_at"] <= now]:
+        release_hold(hold_id)
+    return sum(hold["amount"] for hold in holds.values())
+
+def available_balance(user: dict) -> float:
+    """Balance minus any funds currently on hold"""
+    return user["balance"] - held_amount(user["account_number"])
+
 # Initialize sample users
 def init_sample_data():
     sample_users = [
@@ -101,17 +763,42 @@ def init_sample_data():
     for user_data in sample_users:
         user_id = str(uuid.uuid4())
         account_number = user_data["account_number"]
-        users_db[user_data["username"]] = {
+        add_user({
             "user_id": user_id,
             "username": user_data["username"],
             "email": user_data["email"],
             "phone": user_data["phone"],
-            "password": get_password_hash(user_data["password"]),
+            "password": SAMPLE_PASSWORD_HASHES.get(user_data["password"]) or get_password_hash(user_data["password"]),
             "balance": user_data["initial_balance"],
             "account_number": account_number
-        }
+        })
+
+def load_ledger() -> bool:
+    """Rebuild users, balances and history from the ledger store; False if it was empty"""
+    loaded = False
+    for record in ledger_store.load():
+        loaded = True
+        if record["op"] == "user":
+            add_user(record["user"], persist=False)
+        elif record["op"] == "txn":
+            index_transaction(record["transaction"])
+            for account_number, balance in record["balances"].items():
+                accounts_db[account_number]["balance"] = balance
+    return loaded
+
+if load_ledger():
+    print(f"📒 Recovered {len(users_db)} accounts and {len(transactions_db)} transactions from {BANK_STORAGE_PATH}")
+else:
+    init_sample_data()
 
-init_sample_data()
+@app.on_event("startup")
+async def startup_event():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = BANK_THREADPOOL_SIZE
+
+@app.on_event("shutdown")
+def shutdown_event():
+    password_hasher.shutdown()
+    ledger_store.close()
 
 # Routes
 @app.get("/")
@@ -119,22 +806,32 @@ def read_root():
     return {"message": "Bank Server 1 API", "status": "running"}
 
 @app.post("/register")
-def register(user: UserCreate):
+async def register(user: UserCreate):
+    if user.username in users_db:
+        raise HTTPException(status_code=400, detail="Username already exists")
+    
+    password_hash = await password_hasher.hash(user.password)
+    
+    # Another request may have taken the username while we were hashing
     if user.username in users_db:
         raise HTTPException(status_code=400, detail="Username already exists")
     
     user_id = str(uuid.uuid4())
     account_number = f"BANK1{str(uuid.uuid4())[:8].upper()}"
     
-    users_db[user.username] = {
+    while account_number in accounts_db:
+        account_number = f"BANK1{str(uuid.uuid4())[:8].upper()}"
+    
+    commit = add_user({
         "user_id": user_id,
         "username": user.username,
         "email": user.email,
         "phone": user.phone,
-        "password": get_password_hash(user.password),
+        "password": password_hash,
         "balance": user.initial_balance,
         "account_number": account_number
-    }
+    })
+    await anyio.to_thread.run_sync(commit.wait)
     
     return {
         "message": "User registered successfully",
@@ -143,9 +840,9 @@ def register(user: UserCreate):
     }
 
 @app.post("/login")
-def login(credentials: UserLogin):
+async def login(credentials: UserLogin):
     user = users_db.get(credentials.username)
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await password_hasher.verify(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     access_token = create_access_token(data={"sub": credentials.username})
@@ -159,6 +856,15 @@ def login(credentials: UserLogin):
         }
     }
 
+@app.post("/logout")
+def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    try:
+        payload = decode_token(credentials.credentials)
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    token_cache.invalidate(credentials.credentials, exp=float(payload["exp"]))
+    return {"message": "Logged out"}
+
 @app.get("/account")
 def get_account(username: str = Depends(verify_token)):
     user = users_db.get(username)
@@ -177,13 +883,13 @@ def get_account(username: str = Depends(verify_token)):
 @app.post("/verify-account")
 def verify_account(request: VerifyAccountRequest):
     """Verify if account exists - used by payment gateway"""
-    for user in users_db.values():
-        if user["account_number"] == request.account_number:
-            return {
-                "exists": True,
-                "username": user["username"],
-                "account_number": user["account_number"]
-            }
+    user = get_user_by_account(request.account_number)
+    if user:
+        return {
+            "exists": True,
+            "username": user["username"],
+            "account_number": user["account_number"]
+        }
     return {"exists": False}
 
 @app.post("/authorize-transfer")
@@ -191,15 +897,11 @@ def authorize_transfer(request: AuthorizeTransferRequest):
     """Authorize transfer from sender account - used by payment gateway"""
     try:
         # Verify token
-        payload = jwt.decode(request.token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(request.token)
         username = payload.get("sub")
         
         # Find user by account number
-        user = None
-        for u in users_db.values():
-            if u["account_number"] == request.from_account:
-                user = u
-                break
+        user = get_user_by_account(request.from_account)
         
         if not user:
             return {"authorized": False, "reason": "Account not found"}
@@ -207,75 +909,304 @@ def authorize_transfer(request: AuthorizeTransferRequest):
         if user["username"] != username:
             return {"authorized": False, "reason": "Token does not match account"}
         
-        if user["balance"] < request.amount:
-            return {"authorized": False, "reason": "Insufficient funds"}
-        
-        return {"authorized": True, "current_balance": user["balance"]}
+        with account_locks.locked(user["account_number"]):
+            if available_balance(user) < request.amount:
+                return {"authorized": False, "reason": "Insufficient funds"}
+            
+            return {"authorized": True, "current_balance": user["balance"]}
     
     except JWTError:
         return {"authorized": False, "reason": "Invalid token"}
 
+@app.post("/prepare-transfer")
+def prepare_transfer(request: PrepareTransferRequest):
+    """Verify account, authorize token and hold funds in one call - used by payment gateway"""
+    user = get_user_by_account(request.from_account)
+    if not user:
+        return {"prepared": False, "exists": False, "reason": "Account not found"}
+    
+    try:
+        payload = decode_token(request.token)
+    except JWTError:
+        return {"prepared": False, "exists": True, "reason": "Invalid token"}
+    
+    if user["username"] != payload.get("sub"):
+        return {"prepared": False, "exists": True, "reason": "Token does not match account"}
+    
+    with account_locks.locked(request.from_account):
+        if available_balance(user) < request.amount:
+            return {"prepared": False, "exists": True, "reason": "Insufficient funds"}
+        
+        hold = add_hold(request.from_account, request.amount)
+        
+        return {
+            "prepared": True,
+            "exists": True,
+            "hold_id": hold["hold_id"],
+            "expires_at": hold["expires_at"].isoformat(),
+            "current_balance": user["balance"]
+        }
+
+@app.post("/release-hold")
+def release_hold_endpoint(hold_id: str):
+    """Release funds held by prepare-transfer - called by payment gateway"""
+    hold = holds_db.get(hold_id)
+    if hold:
+        with account_locks.locked(hold["account_number"]):
+            hold = release_hold(hold_id)
+    if not hold:
+        return {"success": False, "reason": "Hold not found"}
+    return {"success": True, "released_amount": hold["amount"]}
+
+# The apply_* functions change balances under the account locks and return
+# (result, ticket); the result may only be sent once ticket.wait() returns
+def apply_debit(account_number: str, amount: float, transaction_id: str, hold_id: Optional[str] = None) -> Tuple[dict, CommitTicket]:
+    user = get_user_by_account(account_number)
+    if not user:
+        return {"success": False, "reason": "Account not found"}, COMMITTED
+    
+    with account_locks.locked(account_number):
+        applied = applied_transactions.get(("debit", transaction_id))
+        if applied:
+            # The funds were taken by the first debit; the retry's own hold is not needed
+            if hold_id and holds_db.get(hold_id, {}).get("account_number") == account_number:
+                release_hold(hold_id)
+            conflict = retry_conflict(applied, account_number, "external", amount)
+            if conflict:
+                return conflict, COMMITTED
+            return {"success": True, "new_balance": user["balance"], "duplicate": True}, COMMITTED
+        
+        hold = holds_db.get(hold_id) if hold_id else None
+        if hold and (hold["account_number"] != account_number or hold["amount"] < amount):
+            return {"success": False, "reason": "Hold does not cover this debit"}, COMMITTED
+        if hold:
+            release_hold(hold_id)
+        if available_balance(user) < amount:
+            return {"success": False, "reason": "Insufficient funds"}, COMMITTED
+        
+        user["balance"] -= amount
+        
+        transaction = {
+            "transaction_id": transaction_id,
+            "from_account": account_number,
+            "to_account": "external",
+            "amount": amount,
+            "timestamp": datetime.utcnow().isoformat(),
+            "status": "completed",
+            "type": "debit"
+        }
+        commit = record_transaction(transaction, {account_number: user["balance"]})
+        return {"success": True, "new_balance": user["balance"]}, commit
+
 @app.post("/debit")
-def debit_account(account_number: str, amount: float, transaction_id: str):
+def debit_account(account_number: str, amount: float, transaction_id: str, hold_id: Optional[str] = None):
     """Debit amount from account - called by payment gateway"""
-    for user in users_db.values():
-        if user["account_number"] == account_number:
-            if user["balance"] >= amount:
-                user["balance"] -= amount
-                
-                transaction = {
-                    "transaction_id": transaction_id,
-                    "from_account": account_number,
-                    "to_account": "external",
-                    "amount": amount,
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "status": "completed",
-                    "type": "debit"
-                }
-                transactions_db.append(transaction)
-                
-                return {"success": True, "new_balance": user["balance"]}
-            else:
-                return {"success": False, "reason": "Insufficient funds"}
+    result, commit = apply_debit(account_number, amount, transaction_id, hold_id)
+    commit.wait()
+    return result
+
+def apply_internal_transfer(request: InternalTransferRequest) -> Tuple[dict, CommitTicket]:
+    sender = get_user_by_account(request.from_account)
+    receiver = get_user_by_account(request.to_account)
+    
+    if not sender:
+        return {"success": False, "error": "sender_not_found", "reason": "Sender account not found"}, COMMITTED
+    if not receiver:
+        return {"success": False, "error": "receiver_not_found", "reason": "Receiver account not found"}, COMMITTED
+    if sender is receiver:
+        return {"success": False, "error": "same_account", "reason": "Cannot transfer to the same account"}, COMMITTED
+    if request.amount <= 0:
+        return {"success": False, "error": "invalid_amount", "reason": "Amount must be greater than zero"}, COMMITTED
+    
+    try:
+        payload = decode_token(request.token)
+    except JWTError:
+        return {"success": False, "error": "unauthorized", "reason": "Invalid token"}, COMMITTED
+    
+    if sender["username"] != payload.get("sub"):
+        return {"success": False, "error": "unauthorized", "reason": "Token does not match account"}, COMMITTED
+    
+    with account_locks.locked(request.from_account, request.to_account):
+        applied = applied_transactions.get(("transfer", request.transaction_id))
+        if applied:
+            conflict = retry_conflict(applied, request.from_account, request.to_account, request.amount)
+            if conflict:
+                return conflict, COMMITTED
+            return {
+                "success": True,
+                "sender_new_balance": sender["balance"],
+                "receiver_new_balance": receiver["balance"],
+                "duplicate": True
+            }, COMMITTED
+        
+        if available_balance(sender) < request.amount:
+            return {"success": False, "error": "unauthorized", "reason": "Insufficient funds"}, COMMITTED
+        
+        # All checks are done before touching either balance, so both legs apply together
+        sender["balance"] -= request.amount
+        receiver["balance"] += request.amount
+        
+        transaction = {
+            "transaction_id": request.transaction_id,
+            "from_account": request.from_account,
+            "to_account": request.to_account,
+            "amount": request.amount,
+            "timestamp": datetime.utcnow().isoformat(),
+            "status": "completed",
+            "type": "transfer"
+        }
+        commit = record_transaction(transaction, {
+            request.from_account: sender["balance"],
+            request.to_account: receiver["balance"]
+        })
+        return {
+            "success": True,
+            "sender_new_balance": sender["balance"],
+            "receiver_new_balance": receiver["balance"]
+        }, commit
+
+@app.post("/internal-transfer")
+def internal_transfer(request: InternalTransferRequest):
+    """Move funds between two accounts of this bank in one step - used by payment gateway"""
+    result, commit = apply_internal_transfer(request)
+    commit.wait()
+    return result
+
+def apply_credit(account_number: str, amount: float, transaction_id: str) -> Tuple[dict, CommitTicket]:
+    user = get_user_by_account(account_number)
+    if not user:
+        return {"success": False, "reason": "Account not found"}, COMMITTED
     
-    return {"success": False, "reason": "Account not found"}
+    with account_locks.locked(account_number):
+        applied = applied_transactions.get(("credit", transaction_id))
+        if applied:
+            conflict = retry_conflict(applied, "external", account_number, amount)
+            if conflict:
+                return conflict, COMMITTED
+            return {"success": True, "new_balance": user["balance"], "duplicate": True}, COMMITTED
+        
+        user["balance"] += amount
+        
+        transaction = {
+            "transaction_id": transaction_id,
+            "from_account": "external",
+            "to_account": account_number,
+            "amount": amount,
+            "timestamp": datetime.utcnow().isoformat(),
+            "status": "completed",
+            "type": "credit"
+        }
+        commit = record_transaction(transaction, {account_number: user["balance"]})
+        return {"success": True, "new_balance": user["balance"]}, commit
 
 @app.post("/credit")
 def credit_account(account_number: str, amount: float, transaction_id: str):
     """Credit amount to account - called by payment gateway"""
-    for user in users_db.values():
-        if user["account_number"] == account_number:
-            user["balance"] += amount
-            
-            transaction = {
-                "transaction_id": transaction_id,
-                "from_account": "external",
-                "to_account": account_number,
-                "amount": amount,
-                "timestamp": datetime.utcnow().isoformat(),
-                "status": "completed",
-                "type": "credit"
-            }
-            transactions_db.append(transaction)
-            
-            return {"success": True, "new_balance": user["balance"]}
-    
-    return {"success": False, "reason": "Account not found"}
+    result, commit = apply_credit(account_number, amount, transaction_id)
+    commit.wait()
+    return result
+
+def bulk_results(applied: List[Tuple[dict, CommitTicket]]) -> dict:
+    """
+    Wait until every ledger write of a bulk call is durable. Tickets
+    resolve in write order, so after the last one the others are done too
+    and only their errors are left to check.
+    """
+    for _, commit in reversed(applied):
+        commit.wait()
+    return {"results": [result for result, _ in applied]}
+
+# Bulk endpoints - used by the payment gateway for batch transfers.
+# Each returns one result per input item, in input order. Ledger writes
+# are all queued before waiting, so a bulk call shares group commits.
+@app.post("/bulk/verify-account")
+def bulk_verify_account(request: BulkVerifyAccountsRequest):
+    return {"results": [verify_account(VerifyAccountRequest(account_number=a)) for a in request.account_numbers]}
+
+@app.post("/bulk/prepare-transfer")
+def bulk_prepare_transfer(request: BulkPrepareTransferRequest):
+    return {"results": [prepare_transfer(t) for t in request.transfers]}
+
+@app.post("/bulk/internal-transfer")
+def bulk_internal_transfer(request: BulkInternalTransferRequest):
+    return bulk_results([apply_internal_transfer(t) for t in request.transfers])
+
+@app.post("/bulk/debit")
+def bulk_debit(request: BulkLedgerRequest):
+    return bulk_results([
+        apply_debit(e.account_number, e.amount, e.transaction_id, e.hold_id)
+        for e in request.entries
+    ])
+
+@app.post("/bulk/credit")
+def bulk_credit(request: BulkLedgerRequest):
+    return bulk_results([
+        apply_credit(e.account_number, e.amount, e.transaction_id)
+        for e in request.entries
+    ])
+
+@app.post("/bulk/release-hold")
+def bulk_release_hold(request: BulkReleaseHoldRequest):
+    return {"results": [release_hold_endpoint(h) for h in request.hold_ids]}
 
 @app.get("/transactions")
-def get_transactions(username: str = Depends(verify_token)):
-    """Get transaction history for user"""
+def get_transactions(
+    username: str = Depends(verify_token),
+    limit: int = DEFAULT_HISTORY_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """
+    Get transaction history for user, newest first
+    
+    Pass the returned next_cursor back as cursor to fetch the following
+    page; since/until restrict the page to a UTC time range.
+    """
     user = users_db.get(username)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    account_number = user["account_number"]
-    user_transactions = [
-        t for t in transactions_db 
-        if t["from_account"] == account_number or t["to_account"] == account_number
-    ]
+    if limit < 1 or limit > MAX_HISTORY_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_HISTORY_PAGE_SIZE}")
+    
+    position = None
+    if cursor is not None:
+        try:
+            position = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    # Stored timestamps are naive UTC
+    if since and since.tzinfo:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    if until and until.tzinfo:
+        until = until.astimezone(timezone.utc).replace(tzinfo=None)
     
-    return {"transactions": user_transactions}
+    history = account_histories.get(user["account_number"])
+    if history is None:
+        return {"transactions": [], "next_cursor": None}
+    
+    user_transactions, next_position = history.page(limit, position, since, until)
+    return {
+        "transactions": user_transactions,
+        "next_cursor": str(next_position) if next_position is not None else None
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Latency histograms in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/storage/stats")
+def get_storage_stats():
+    """Ledger persistence counters"""
+    return ledger_store.stats()
+
+@app.get("/token-cache/stats")
+def get_token_cache_stats():
+    """Token verification cache counters"""
+    return token_cache.stats()
 
 @app.get("/users")
 def list_users():
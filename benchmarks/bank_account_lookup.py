@@ -0,0 +1,82 @@
+"""
+Account lookup benchmark for the bank services.
+
+Measures verify_account / debit / credit latency as the number of accounts
+grows, against the old full scan over users_db.values().
+
+Usage (from the project root):
+    python benchmarks/bank_account_lookup.py
+"""
+import importlib.util
+import os
+import random
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [1_000, 10_000, 100_000, 300_000]
+LOOKUPS = 2_000
+
+
+def load_bank():
+    spec = importlib.util.spec_from_file_location("bank1_main", os.path.join(ROOT, "bank1", "main.py"))
+    bank = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bank)
+    return bank
+
+
+def populate(bank, count):
+    bank.users_db.clear()
+    bank.accounts_db.clear()
+    for i in range(count):
+        bank.add_user({
+            "user_id": str(uuid.uuid4()),
+            "username": f"user{i}",
+            "email": f"user{i}@bench.local",
+            "phone": "0000000000",
+            "password": "not-a-real-hash",
+            "balance": 1_000_000.0,
+            "account_number": f"BANK1{i:08d}"
+        })
+
+
+def linear_scan(bank, account_number):
+    for user in bank.users_db.values():
+        if user["account_number"] == account_number:
+            return user
+    return None
+
+
+def debit_and_credit(bank, account_number):
+    transaction_id = str(uuid.uuid4())
+    bank.debit_account(account_number, 1.0, transaction_id)
+    bank.credit_account(account_number, 1.0, transaction_id)
+
+
+def time_per_call(fn, keys):
+    start = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    bank = load_bank()
+    print(f"{'accounts':>10} {'verify (us)':>12} {'debit+credit (us)':>18} {'old scan (us)':>14}")
+    for size in SIZES:
+        populate(bank, size)
+        keys = [f"BANK1{random.randrange(size):08d}" for _ in range(LOOKUPS)]
+        verify_us = time_per_call(
+            lambda k: bank.verify_account(bank.VerifyAccountRequest(account_number=k)), keys
+        )
+        ledger_us = time_per_call(lambda k: debit_and_credit(bank, k), keys)
+        # The scan is O(n); sample fewer keys so large sizes finish quickly
+        scan_us = time_per_call(lambda k: linear_scan(bank, k), keys[:50])
+        print(f"{size:>10} {verify_us:>12.2f} {ledger_us:>18.2f} {scan_us:>14.2f}")
+        bank.transactions_db.clear()
+        bank.applied_transactions.clear()
+        bank.account_histories.clear()
+
+
+if __name__ == "__main__":
+    main()
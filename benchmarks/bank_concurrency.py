@@ -0,0 +1,102 @@
+"""
+Concurrent ledger benchmark for the bank services.
+
+Hammers debit, credit and internal-transfer from many threads at once and
+checks that no balance update is lost (total money is conserved and the
+ledger replays to the final balances).
+
+Usage (from the project root):
+    python benchmarks/bank_concurrency.py
+"""
+import importlib.util
+import os
+import random
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCOUNTS = 1_000
+OPS_PER_THREAD = 5_000
+THREAD_COUNTS = [1, 2, 4, 8, 16, 32]
+START_BALANCE = 1_000.0
+
+
+def load_bank():
+    spec = importlib.util.spec_from_file_location("bank1_main", os.path.join(ROOT, "bank1", "main.py"))
+    bank = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bank)
+    return bank
+
+
+def reset(bank):
+    bank.users_db.clear()
+    bank.accounts_db.clear()
+    bank.transactions_db.clear()
+    bank.applied_transactions.clear()
+    bank.account_histories.clear()
+    tokens = {}
+    for i in range(ACCOUNTS):
+        account_number = f"BANK1{i:08d}"
+        bank.add_user({
+            "user_id": str(uuid.uuid4()),
+            "username": f"user{i}",
+            "email": f"user{i}@bench.local",
+            "phone": "0000000000",
+            "password": "not-a-real-hash",
+            "balance": START_BALANCE,
+            "account_number": account_number
+        })
+        tokens[account_number] = bank.create_access_token({"sub": f"user{i}"})
+    return tokens
+
+
+def worker(bank, tokens, seed):
+    rng = random.Random(seed)
+    accounts = list(tokens)
+    for _ in range(OPS_PER_THREAD):
+        sender, receiver = rng.sample(accounts, 2)
+        amount = float(rng.randint(1, 20))
+        if rng.random() < 0.5:
+            bank.internal_transfer(bank.InternalTransferRequest(
+                from_account=sender,
+                to_account=receiver,
+                amount=amount,
+                token=tokens[sender],
+                transaction_id=str(uuid.uuid4())
+            ))
+        else:
+            transaction_id = str(uuid.uuid4())
+            if bank.debit_account(sender, amount, transaction_id)["success"]:
+                bank.credit_account(receiver, amount, transaction_id)
+
+
+def check(bank):
+    total = sum(u["balance"] for u in bank.users_db.values())
+    expected = {a: START_BALANCE for a in bank.accounts_db}
+    for t in bank.transactions_db:
+        if t["from_account"] in expected:
+            expected[t["from_account"]] -= t["amount"]
+        if t["to_account"] in expected:
+            expected[t["to_account"]] += t["amount"]
+    mismatched = sum(1 for a, u in bank.accounts_db.items() if abs(u["balance"] - expected[a]) > 1e-6)
+    return abs(total - START_BALANCE * ACCOUNTS) < 1e-6 and mismatched == 0
+
+
+def main():
+    bank = load_bank()
+    print(f"{'threads':>8} {'ops/s':>10} {'consistent':>11}")
+    for count in THREAD_COUNTS:
+        tokens = reset(bank)
+        threads = [threading.Thread(target=worker, args=(bank, tokens, seed)) for seed in range(count)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        print(f"{count:>8} {count * OPS_PER_THREAD / elapsed:>10.0f} {str(check(bank)):>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Ledger durability benchmark for the bank services.
+
+Runs concurrent internal transfers against each storage backend and
+reports transfers per second, plus how many records each group commit
+carried on average.
+
+Usage (from the project root):
+    python benchmarks/bank_durability.py
+"""
+import importlib.util
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCOUNTS = 1_000
+THREADS = 32
+TRANSFERS_PER_THREAD = 300
+MODES = [
+    ("memory", "memory", "true"),
+    ("log, no fsync", "log", "false"),
+    ("log, fsync", "log", "true"),
+    ("sqlite, no fsync", "sqlite", "false"),
+    ("sqlite, fsync", "sqlite", "true"),
+]
+
+
+def load_bank(storage, path, fsync):
+    os.environ["BANK_STORAGE"] = storage
+    os.environ["BANK_STORAGE_PATH"] = path
+    os.environ["BANK_STORAGE_FSYNC"] = fsync
+    spec = importlib.util.spec_from_file_location(f"bank1_{storage}_{fsync}", os.path.join(ROOT, "bank1", "main.py"))
+    bank = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bank)
+    return bank
+
+
+def create_accounts(bank):
+    tokens = {}
+    for i in range(ACCOUNTS):
+        account_number = f"BANK1{i:08d}"
+        bank.add_user({
+            "user_id": str(uuid.uuid4()),
+            "username": f"user{i}",
+            "email": f"user{i}@bench.local",
+            "phone": "0000000000",
+            "password": "not-a-real-hash",
+            "balance": 1_000_000.0,
+            "account_number": account_number
+        })
+        tokens[account_number] = bank.create_access_token({"sub": f"user{i}"})
+    return tokens
+
+
+def worker(bank, tokens, seed):
+    rng = random.Random(seed)
+    accounts = list(tokens)
+    for _ in range(TRANSFERS_PER_THREAD):
+        sender, receiver = rng.sample(accounts, 2)
+        bank.internal_transfer(bank.InternalTransferRequest(
+            from_account=sender,
+            to_account=receiver,
+            amount=1.0,
+            token=tokens[sender],
+            transaction_id=str(uuid.uuid4())
+        ))
+
+
+def main():
+    print(f"{'backend':>18} {'transfers/s':>12} {'records/commit':>15}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, storage, fsync in MODES:
+            path = os.path.join(tmp, f"{storage}-{fsync}")
+            bank = load_bank(storage, path, fsync)
+            tokens = create_accounts(bank)
+            threads = [threading.Thread(target=worker, args=(bank, tokens, seed)) for seed in range(THREADS)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            stats = bank.ledger_store.stats()
+            bank.ledger_store.close()
+            print(f"{label:>18} {THREADS * TRANSFERS_PER_THREAD / elapsed:>12.0f} {stats.get('avg_records_per_commit', 0.0):>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
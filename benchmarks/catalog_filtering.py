@@ -0,0 +1,94 @@
+"""
+Catalog filtering benchmark for the shopping backend.
+
+Runs brand, category, price band and stock threshold queries against the
+old chained list comprehensions over products_db, the per-product indexes
+(CatalogIndex) and the NumPy column arrays (ColumnarCatalog), and reports
+milliseconds per query.
+
+Usage (from the project root, needs numpy):
+    python benchmarks/catalog_filtering.py
+"""
+import importlib.util
+import os
+import random
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [10_000, 100_000, 1_000_000]
+BRANDS = [f"Brand{i}" for i in range(50)]
+CATEGORIES = [f"Category{i}" for i in range(20)]
+QUERIES = {
+    "price band": {"min_price": 100.0, "max_price": 150.0},
+    "brand + price": {"brand": "brand7", "min_price": 500.0},
+    "category + stock": {"category": "CATEGORY3", "min_stock": 400},
+    "brand + category": {"brand": "Brand1", "category": "Category2"},
+    "price + stock": {"max_price": 900.0, "min_stock": 50},
+}
+REPEATS = 5
+
+
+def load_shop():
+    os.environ["CATALOG_COLUMNAR"] = "true"
+    spec = importlib.util.spec_from_file_location("shopping_main", os.path.join(ROOT, "shopping-app", "backend", "main.py"))
+    shop = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(shop)
+    return shop
+
+
+def make_products(count, rng):
+    return [{
+        "product_id": f"SKU-{i:08d}",
+        "name": f"Product {i}",
+        "brand": rng.choice(BRANDS),
+        "category": rng.choice(CATEGORIES),
+        "price": round(rng.uniform(1, 2000), 2),
+        "description": "Benchmark product",
+        "stock": rng.randrange(500),
+        "image_url": None
+    } for i in range(count)]
+
+
+def list_path(products, brand=None, category=None, min_price=None, max_price=None, min_stock=None):
+    results = products.copy()
+    if brand:
+        results = [p for p in results if p["brand"].lower() == brand.lower()]
+    if category:
+        results = [p for p in results if p["category"].lower() == category.lower()]
+    if min_price is not None:
+        results = [p for p in results if p["price"] >= min_price]
+    if max_price is not None:
+        results = [p for p in results if p["price"] <= max_price]
+    if min_stock is not None:
+        results = [p for p in results if p["stock"] >= min_stock]
+    return results
+
+
+def time_ms(fn):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        result = fn()
+    return (time.perf_counter() - start) / REPEATS * 1e3, len(result)
+
+
+def main():
+    shop = load_shop()
+    rng = random.Random(42)
+    print(f"{'products':>10} {'query':>17} {'matches':>8} {'list (ms)':>10} {'index (ms)':>11} {'columnar (ms)':>14}")
+    for size in SIZES:
+        products = make_products(size, rng)
+        # Text search is not part of this benchmark, so the search index is skipped
+        catalog = shop.CatalogIndex()
+        catalog.extend(products)
+        columnar = shop.ColumnarCatalog()
+        columnar.extend(products)
+        for label, query in QUERIES.items():
+            list_ms, matches = time_ms(lambda: list_path(products, **query))
+            index_ms, index_matches = time_ms(lambda: catalog.select(**query))
+            columnar_ms, columnar_matches = time_ms(lambda: columnar.select(**query))
+            assert matches == index_matches == columnar_matches
+            print(f"{size:>10} {label:>17} {matches:>8} {list_ms:>10.2f} {index_ms:>11.2f} {columnar_ms:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 export async function POST(request) {
   try {
-    const { fromAccount, toAccount, amount, token, description } = await request.json();
+    const { fromAccount, toAccount, amount, token, description, idempotencyKey } = await request.json();
     
     // Validate required fields
     if (!fromAccount || !toAccount || !amount || !token) {
@@ -24,9 +24,15 @@ export async function POST(request) {
     const gatewayUrl = process.env.PAYMENT_GATEWAY_URL || 'http://localhost:8000';
     console.log('Sending transfer to gateway:', { fromAccount, toAccount, amount: parsedAmount });
     
+    // Retries of the same confirmed transfer reuse its key, so the gateway never moves the money twice
+    const headers = { 'Content-Type': 'application/json' };
+    if (idempotencyKey) {
+      headers['Idempotency-Key'] = idempotencyKey;
+    }
+    
     const response = await fetch(`${gatewayUrl}/transfer`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
+      headers,
       body: JSON.stringify({
         from_account: fromAccount,
         to_account: toAccount,
@@ -38,6 +44,14 @@ export async function POST(request) {
 
     const data = await response.json();
     console.log('Gateway response:', data);
+    if (!response.ok && data.detail) {
+      // Rejected by the gateway (e.g. rate or amount limits); keep any Retry-After
+      const retryAfter = response.headers.get('Retry-After');
+      return Response.json({
+        success: false,
+        message: typeof data.detail === 'string' ? data.detail : 'Transfer rejected'
+      }, { status: response.status, headers: retryAfter ? { 'Retry-After': retryAfter } : {} });
+    }
     return Response.json(data);
   } catch (error) {
     console.error('Transfer API error:', error);
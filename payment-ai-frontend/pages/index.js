@@ -134,7 +134,8 @@ export default function Home() {
             setPendingTransfer({
               toAccount: recipientAccount,
               amount: aiResponse.data.amount,
-              description: text
+              description: text,
+              idempotencyKey: crypto.randomUUID()
             })
             addMessage('assistant', aiResponse.message)
           }
@@ -219,7 +220,8 @@ export default function Home() {
           toAccount: pendingTransfer.toAccount,
           amount: pendingTransfer.amount,
           token: userContext.token,
-          description: pendingTransfer.description
+          description: pendingTransfer.description,
+          idempotencyKey: pendingTransfer.idempotencyKey
         })
       })
 
@@ -261,7 +263,8 @@ export default function Home() {
       amount: product.price,
       description: `Purchase: ${product.name}`,
       isProductPurchase: true,
-      productDetails: product
+      productDetails: product,
+      idempotencyKey: crypto.randomUUID()
     })
   }
 
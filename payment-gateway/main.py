@@ -1,13 +1,48 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Dict, List
+from contextlib import asynccontextmanager, AsyncExitStack
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from bisect import bisect_left, bisect_right
 import httpx
+import asyncio
+import glob
+import hashlib
+import json
+import math
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 
-app = FastAPI(title="Payment Gateway", version="1.0")
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows: a worker can't tell whether another one's WAL is
+    # orphaned, so only one worker may use GATEWAY_WAL_PATH (see TransferWAL._claim)
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    yield
+    await shutdown()
+
+app = FastAPI(title="Payment Gateway", version="1.0", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -18,14 +53,1641 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Bank endpoints - use environment variables for production
+# Metrics: Prometheus-style latency histograms, exposed on /metrics.
+# Observations are only made on the event loop, so they need no locking.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per tuple of label values"""
+
+    def __init__(self, name: str, description: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, seconds: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for labels, series in list(self._series.items()):
+            label_text = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, labels))
+            bucket_prefix = label_text + "," if label_text else ""
+            total = 0
+            for bound, count in zip(bounds, series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{bucket_prefix}le="{bound}"}} {total}')
+            series_labels = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{series_labels} {series[-1]}")
+            lines.append(f"{self.name}_count{series_labels} {total}")
+        return lines
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Gauge:
+    """Current values read from a callback at scrape time, so keeping them costs nothing"""
+
+    def __init__(self, name: str, description: str, labelnames: tuple, read):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.read = read  # () -> {label values: value}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for labels, value in self.read().items():
+            label_text = ",".join(f'{name}="{escape_label(v)}"' for name, v in zip(self.labelnames, labels))
+            lines.append(f"{self.name}{{{label_text}}} {value}" if label_text else f"{self.name} {value}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def histogram(self, name: str, description: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, description, labelnames, buckets)
+        self._metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, description: str, labelnames: tuple, read) -> Gauge:
+        gauge = Gauge(name, description, labelnames, read)
+        self._metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request",
+    ("method", "route", "status")
+)
+
+class RequestMetricsMiddleware:
+    """Plain ASGI middleware (cheaper than @app.middleware) timing every request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template, not the raw path, keeps path parameters out of the labels
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status_code)
+            )
+
+app.add_middleware(RequestMetricsMiddleware)
+
+TRANSFER_STAGE_SECONDS = metrics.histogram(
+    "gateway_transfer_stage_seconds",
+    "Time spent in each stage of a transfer",
+    ("stage", "outcome")
+)
+BANK_CALL_SECONDS = metrics.histogram(
+    "gateway_bank_call_seconds",
+    "Latency of calls from the gateway to the banks",
+    ("bank", "path", "outcome")
+)
+
+# Bank routing: GATEWAY_ROUTES_PATH names a JSON routing table (see
+# routes.example.json) that is reloaded when it changes. Without it the
+# gateway routes to the two demo banks below.
+GATEWAY_ROUTES_PATH = os.getenv("GATEWAY_ROUTES_PATH")
+ROUTES_RELOAD_INTERVAL = float(os.getenv("ROUTES_RELOAD_INTERVAL", "5"))
 BANK_SERVERS = {
     "BANK1": os.getenv("BANK1_URL", "http://localhost:8001"),
     "BANK2": os.getenv("BANK2_URL", "http://localhost:8002")
 }
+DEFAULT_ROUTES = {
+    "banks": {bank_name: {"prefixes": [bank_name], "endpoints": [url]} for bank_name, url in BANK_SERVERS.items()}
+}
+
+# Outbound HTTP settings for bank calls
+BANK_HTTP_MAX_CONNECTIONS = int(os.getenv("BANK_HTTP_MAX_CONNECTIONS", "100"))
+BANK_HTTP_MAX_KEEPALIVE = int(os.getenv("BANK_HTTP_MAX_KEEPALIVE", "20"))
+BANK_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("BANK_HTTP_KEEPALIVE_EXPIRY", "30"))
+BANK_HTTP_TIMEOUT = float(os.getenv("BANK_HTTP_TIMEOUT", "10"))
+BANK_HTTP_CONNECT_TIMEOUT = float(os.getenv("BANK_HTTP_CONNECT_TIMEOUT", "5"))
+BANK_HTTP2 = os.getenv("BANK_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# End-to-end time budget for one transfer / one batch; every bank call in it
+# gets at most the remaining budget (and never more than BANK_HTTP_TIMEOUT)
+TRANSFER_SLO_SECONDS = float(os.getenv("TRANSFER_SLO_SECONDS", "5"))
+BATCH_SLO_SECONDS = float(os.getenv("BATCH_SLO_SECONDS", "30"))
+# Retries of idempotent bank calls (reads, and writes the banks deduplicate
+# by transaction id), with full-jitter exponential backoff
+BANK_RETRY_ATTEMPTS = int(os.getenv("BANK_RETRY_ATTEMPTS", "2"))
+BANK_RETRY_BASE_DELAY = float(os.getenv("BANK_RETRY_BASE_DELAY", "0.05"))
+# Send a second copy of a read if the first has not answered after this
+# many seconds, and use whichever answers first; 0 disables hedging
+BANK_HEDGE_DELAY = float(os.getenv("BANK_HEDGE_DELAY", "0"))
+
+# Circuit breaker per bank: open after this many consecutive failures, then
+# let one trial request through every CIRCUIT_RESET_SECONDS
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "10"))
+# Background bank health probes
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "5"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+
+# Admission control, checked before any bank call. Token buckets per sender
+# account and per client address (rate per second, burst), and sliding-window
+# velocity limits per sender account; 0 disables a limit. The per-account
+# limits are off unless the operator sets them
+RATE_LIMIT_ACCOUNT_RPS = float(os.getenv("RATE_LIMIT_ACCOUNT_RPS", "0"))
+RATE_LIMIT_ACCOUNT_BURST = float(os.getenv("RATE_LIMIT_ACCOUNT_BURST", "10"))
+RATE_LIMIT_CLIENT_RPS = float(os.getenv("RATE_LIMIT_CLIENT_RPS", "100"))
+RATE_LIMIT_CLIENT_BURST = float(os.getenv("RATE_LIMIT_CLIENT_BURST", "200"))
+VELOCITY_WINDOW_SECONDS = float(os.getenv("VELOCITY_WINDOW_SECONDS", "3600"))
+VELOCITY_MAX_COUNT = int(os.getenv("VELOCITY_MAX_COUNT", "0"))
+VELOCITY_MAX_AMOUNT = float(os.getenv("VELOCITY_MAX_AMOUNT", "0"))
+ADMISSION_MAX_KEYS = int(os.getenv("ADMISSION_MAX_KEYS", "100000"))
+
+# Async mode for /transfer (per request with "Prefer: respond-async", or for
+# every request with ASYNC_TRANSFERS): reply 202 at once and let a worker
+# pool execute the transfer, with at most TRANSFER_WORKERS_PER_BANK
+# transfers in progress against any one bank
+ASYNC_TRANSFERS = os.getenv("ASYNC_TRANSFERS", "false").lower() in ("1", "true", "yes")
+TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", "32"))
+TRANSFER_WORKERS_PER_BANK = int(os.getenv("TRANSFER_WORKERS_PER_BANK", "16"))
+TRANSFER_QUEUE_SIZE = int(os.getenv("TRANSFER_QUEUE_SIZE", "10000"))
+TRANSFER_JOBS_MAX = int(os.getenv("TRANSFER_JOBS_MAX", "100000"))
+MAX_POLL_WAIT_SECONDS = 30.0
+
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+# With shared state, a worker holds a key it is executing for this long and
+# renews the lease while it runs; a worker that dies loses its keys once
+# the lease runs out, and requests waiting on them get 409
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "15"))
+# Transaction ids of keyed transfers are derived from the key, so a retry
+# reuses the same id and the banks recognise debits/credits already applied
+IDEMPOTENCY_NAMESPACE = uuid.UUID("6f1c1f8e-5d0b-4f57-9a53-3b8f3b0c2a11")
+
+# Write-ahead log of cross-bank transfer states, replayed on startup
+GATEWAY_WAL_PATH = os.getenv("GATEWAY_WAL_PATH", "gateway_wal.jsonl")
+GATEWAY_WAL_FSYNC = os.getenv("GATEWAY_WAL_FSYNC", "true").lower() in ("1", "true", "yes")
+GATEWAY_WAL_COMPACT_RECORDS = int(os.getenv("GATEWAY_WAL_COMPACT_RECORDS", "100000"))
+COMPENSATION_RETRY_DELAY = float(os.getenv("COMPENSATION_RETRY_DELAY", "1"))
+COMPENSATION_MAX_DELAY = float(os.getenv("COMPENSATION_MAX_DELAY", "60"))
+# Refunds are credits to the sender under an id derived from the transfer's
+REFUND_NAMESPACE = uuid.UUID("0b9e4a55-2f7c-4c1e-8d3a-5e6f7a8b9c0d")
+
+# Transaction log: the newest TRANSACTION_LOG_HOT_LIMIT records and their indexes
+# stay in memory, older ones are moved in chunks of TRANSACTION_LOG_SEGMENT_SIZE
+# to segment files with their own index files
+TRANSACTION_LOG_HOT_LIMIT = int(os.getenv("TRANSACTION_LOG_HOT_LIMIT", "10000"))
+TRANSACTION_LOG_SEGMENT_SIZE = int(os.getenv("TRANSACTION_LOG_SEGMENT_SIZE", "5000"))
+TRANSACTION_LOG_DIR = os.getenv("TRANSACTION_LOG_DIR") or tempfile.gettempdir()
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Gateway state: "memory" keeps the transaction log, idempotency results,
+# rate limit counters and async job status in this process; "sqlite" keeps
+# them in one database that every worker of `uvicorn --workers N` opens
+GATEWAY_STORAGE = os.getenv("GATEWAY_STORAGE", "memory").lower()
+GATEWAY_STORAGE_PATH = os.getenv("GATEWAY_STORAGE_PATH", "gateway_state.sqlite3")
+# How often a worker re-reads shared state while waiting on another worker
+SHARED_STATE_POLL_INTERVAL = float(os.getenv("SHARED_STATE_POLL_INTERVAL", "0.05"))
+# Expired and idle rows are swept from the shared database at most this often
+SHARED_STATE_PRUNE_INTERVAL = 60.0
+# A request whose state update has waited this long for another worker's
+# write gets 503; records of outcomes the banks already applied keep
+# retrying for up to SHARED_STATE_RECORD_TIMEOUT seconds instead
+SHARED_STATE_BUSY_TIMEOUT = float(os.getenv("SHARED_STATE_BUSY_TIMEOUT", "0.25"))
+SHARED_STATE_RECORD_TIMEOUT = float(os.getenv("SHARED_STATE_RECORD_TIMEOUT", "30"))
+
+class SQLiteState:
+    """
+    SQLite database (WAL mode) for the gateway state every worker process
+    must see the same way. Statements run one at a time, in the order they
+    were submitted, on a dedicated thread, so waiting for another worker's
+    write never blocks the event loop. That wait is bounded by
+    SHARED_STATE_BUSY_TIMEOUT and then answered with 503, except for
+    record=True calls, which store what already happened at the banks.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS transactions ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id TEXT UNIQUE, timestamp TEXT, "
+        "from_account TEXT, to_account TEXT, sender_bank TEXT, receiver_bank TEXT, record TEXT)",
+        "CREATE INDEX IF NOT EXISTS transactions_timestamp ON transactions (timestamp)",
+        "CREATE INDEX IF NOT EXISTS transactions_from_account ON transactions (from_account)",
+        "CREATE INDEX IF NOT EXISTS transactions_to_account ON transactions (to_account)",
+        "CREATE INDEX IF NOT EXISTS transactions_sender_bank ON transactions (sender_bank)",
+        "CREATE INDEX IF NOT EXISTS transactions_receiver_bank ON transactions (receiver_bank)",
+        "CREATE TABLE IF NOT EXISTS idempotency ("
+        "key TEXT PRIMARY KEY, fingerprint TEXT, response TEXT, owner INTEGER, expires_at REAL)",
+        "CREATE TABLE IF NOT EXISTS rate_limits ("
+        "limiter TEXT, key TEXT, state TEXT, updated_at REAL, PRIMARY KEY (limiter, key))",
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id TEXT UNIQUE, status TEXT, job TEXT)"
+    )
+
+    def __init__(self, path: str, busy_timeout: float, record_timeout: float):
+        self.path = path
+        self.record_timeout = record_timeout
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gateway-state")
+        self.busy_rejections = 0
+
+    async def _run(self, work, record: bool):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, work, record)
+
+    def _call(self, work, record: bool):
+        deadline = time.monotonic() + self.record_timeout
+        while True:
+            try:
+                return work()
+            except sqlite3.OperationalError as e:
+                # Another worker held the write lock for the whole busy timeout
+                if "locked" not in str(e) or (record and time.monotonic() >= deadline):
+                    raise
+                if not record:
+                    self.busy_rejections += 1
+                    raise HTTPException(
+                        status_code=503,
+                        detail="Gateway state is busy, please retry",
+                        headers={"Retry-After": "1"}
+                    )
+
+    async def query(self, sql: str, params: tuple = ()) -> list:
+        return await self._run(lambda: self._conn.execute(sql, params).fetchall(), False)
+
+    async def execute(self, sql: str, params: tuple = (), record: bool = False) -> int:
+        """Run one write statement; returns the number of rows changed"""
+        return await self._run(lambda: self._conn.execute(sql, params).rowcount, record)
+
+    async def transaction(self, work, record: bool = False):
+        """
+        Read-modify-write: work(conn) runs between BEGIN IMMEDIATE and
+        COMMIT, which keeps other workers from writing in between
+        """
+        def run():
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+        return await self._run(run, record)
+
+    async def update_limiter(self, limiter: str, key: str, now: float, initial: list, update):
+        """Apply update() to the limiter's state for key in one transaction and return its result"""
+        def work(conn):
+            row = conn.execute("SELECT state FROM rate_limits WHERE limiter = ? AND key = ?", (limiter, key)).fetchone()
+            state = json.loads(row[0]) if row else initial
+            result = update(state)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (limiter, key, state, updated_at) VALUES (?, ?, ?, ?)",
+                (limiter, key, json.dumps(state), now)
+            )
+            return result
+        return await self.transaction(work)
+
+    async def prune_limiter(self, limiter: str, idle_before: float):
+        await self.execute("DELETE FROM rate_limits WHERE limiter = ? AND updated_at < ?", (limiter, idle_before))
+
+    async def count_limiter(self, limiter: str) -> int:
+        return (await self.query("SELECT COUNT(*) FROM rate_limits WHERE limiter = ?", (limiter,)))[0][0]
+
+    def close(self):
+        # Lets statements already submitted finish first
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+if GATEWAY_STORAGE not in ("memory", "sqlite"):
+    raise ValueError(f"Unknown GATEWAY_STORAGE '{GATEWAY_STORAGE}', expected memory or sqlite")
+if GATEWAY_STORAGE == "sqlite":
+    shared_state = SQLiteState(GATEWAY_STORAGE_PATH, SHARED_STATE_BUSY_TIMEOUT, SHARED_STATE_RECORD_TIMEOUT)
+else:
+    shared_state = None
+
+class TransactionStore:
+    """
+    Gateway transaction log. Every record gets a sequence number. The
+    newest hot_limit records are kept in memory with dense id, account,
+    bank and timestamp indexes; older ones are moved in chunks to
+    JSON-lines segment files. Each segment has an index file: one line of
+    record offsets and timestamps, then INDEX_BUCKETS lines that split the
+    id, account and bank postings by key hash, so a lookup reads one
+    bucket. In memory a segment is only its sequence and time range and
+    the bucket positions; spilled transaction ids are found through a few
+    sorted runs of their hashes, each tagged with its segment (8 bytes per
+    record, against a few hundred for the hot indexes). Keys are hashed
+    with hash(), which is stable for the life of the process, and segments
+    don't outlive it.
+    Timestamps are kept in sequence order, so time ranges become sequence
+    ranges by bisect. The methods are coroutines to match
+    SQLiteTransactionStore.
+    """
+    INDEX_BUCKETS = 256
+    # The low bits of an id run entry hold the segment number instead of hash bits
+    SEGMENT_BITS = 20
+    # Offsets and timestamps of this many segments are kept after use
+    META_CACHE_SIZE = 4
+
+    def __init__(self, base_directory: str, hot_limit: int, segment_size: int):
+        self.base_directory = base_directory
+        self.hot_limit = hot_limit
+        self.segment_size = segment_size
+        self.directory = None
+        self._next_seq = 0
+        self._last_timestamp: Optional[datetime] = None
+        self._hot: "OrderedDict[int, dict]" = OrderedDict()  # seq -> record
+        self._hot_ids: Dict[str, int] = {}  # transaction_id -> seq
+        self._hot_timestamps: List[datetime] = []  # timestamps of the hot records, oldest first
+        self._hot_accounts: Dict[str, List[int]] = {}  # account -> seqs
+        self._hot_banks: Dict[str, List[int]] = {}  # bank -> seqs
+        self._segments: List[dict] = []
+        # Sorted arrays of id hash | segment number, merged like a binary
+        # counter so there are only O(log n) of them to search
+        self._id_runs: List[array] = []
+        self._metas: "OrderedDict[int, dict]" = OrderedDict()  # first_seq -> offsets and timestamps
+
+    async def count(self) -> int:
+        return self._next_seq
+
+    async def append(self, record: dict) -> dict:
+        """Add a record; a transaction id already in the log is not added twice"""
+        existing = await self.get(record["transaction_id"])
+        if existing is not None:
+            return existing
+        seq = self._next_seq
+        self._next_seq += 1
+        timestamp = datetime.fromisoformat(record["timestamp"])
+        # Keep timestamps sorted even if the clock steps backwards
+        if self._last_timestamp is not None and timestamp < self._last_timestamp:
+            timestamp = self._last_timestamp
+        self._last_timestamp = timestamp
+        self._hot_timestamps.append(timestamp)
+        self._hot_ids[record["transaction_id"]] = seq
+        self._hot[seq] = record
+        for account in {record["from_account"], record["to_account"]}:
+            self._hot_accounts.setdefault(account, []).append(seq)
+        for bank in {record["sender_bank"], record["receiver_bank"]}:
+            self._hot_banks.setdefault(bank, []).append(seq)
+        if len(self._hot) > self.hot_limit:
+            self._spill()
+        return record
+
+    def _spill(self):
+        """Move the oldest hot records to a segment, dropping their entries from the hot indexes"""
+        if self.directory is None:
+            os.makedirs(self.base_directory, exist_ok=True)
+            self.directory = tempfile.mkdtemp(prefix="gateway-transactions-", dir=self.base_directory)
+        count = min(self.segment_size, len(self._hot))
+        first_seq = next(iter(self._hot))
+        path = os.path.join(self.directory, f"segment-{first_seq:012d}.jsonl")
+        timestamps = self._hot_timestamps[:count]
+        del self._hot_timestamps[:count]
+        records = []
+        offsets = []
+        ids: Dict[str, int] = {}  # transaction_id -> offset
+        offset = 0
+        for seq in range(first_seq, first_seq + count):
+            record = self._hot.pop(seq)
+            line = json.dumps(record).encode("utf-8") + b"\n"
+            records.append(line)
+            offsets.append(offset)
+            ids[record["transaction_id"]] = offset
+            del self._hot_ids[record["transaction_id"]]
+            offset += len(line)
+        with open(path, "wb") as f:
+            f.writelines(records)
+        
+        buckets = [{"ids": {}, "accounts": {}, "banks": {}} for _ in range(self.INDEX_BUCKETS)]
+        for transaction_id, offset in ids.items():
+            buckets[hash(transaction_id) % self.INDEX_BUCKETS]["ids"][transaction_id] = offset
+        # The spilled records are the oldest, so each hot list hands over its front
+        end = first_seq + count
+        for kind, hot in (("accounts", self._hot_accounts), ("banks", self._hot_banks)):
+            for key in list(hot):
+                seqs = hot[key]
+                if seqs[0] >= end:
+                    continue
+                cut = bisect_left(seqs, end)
+                spilled = seqs[:cut]
+                buckets[hash(key) % self.INDEX_BUCKETS][kind][key] = (spilled, [offsets[seq - first_seq] for seq in spilled])
+                if cut == len(seqs):
+                    del hot[key]
+                else:
+                    del seqs[:cut]
+        lines = [json.dumps({"offsets": offsets, "timestamps": [t.isoformat() for t in timestamps]}).encode("utf-8") + b"\n"]
+        lines += [json.dumps(bucket).encode("utf-8") + b"\n" for bucket in buckets]
+        with open(path + ".index", "wb") as f:
+            f.writelines(lines)
+        positions = array("Q", [0])
+        for line in lines:
+            positions.append(positions[-1] + len(line))
+        
+        number = len(self._segments)
+        mask = (1 << self.SEGMENT_BITS) - 1
+        run = array("q", sorted(hash(transaction_id) & ~mask | number for transaction_id in ids))
+        while self._id_runs and len(self._id_runs[-1]) <= len(run):
+            # Both halves are sorted, which sorted() merges in linear time
+            run = array("q", sorted(self._id_runs.pop() + run))
+        self._id_runs.append(run)
+        self._segments.append({
+            "first_seq": first_seq,
+            "count": count,
+            "path": path,
+            "first_timestamp": timestamps[0],
+            "last_timestamp": timestamps[-1],
+            # positions[0] starts the offsets line, positions[1 + b] bucket b
+            "positions": positions
+        })
+
+    def _bucket(self, segment: dict, key: str) -> dict:
+        b = 1 + hash(key) % self.INDEX_BUCKETS
+        start, end = segment["positions"][b], segment["positions"][b + 1]
+        with open(segment["path"] + ".index", "rb") as f:
+            f.seek(start)
+            return json.loads(f.read(end - start))
+
+    def _meta(self, segment: dict) -> dict:
+        meta = self._metas.get(segment["first_seq"])
+        if meta is None:
+            with open(segment["path"] + ".index", "rb") as f:
+                meta = json.loads(f.read(segment["positions"][1]))
+            meta["timestamps"] = [datetime.fromisoformat(timestamp) for timestamp in meta["timestamps"]]
+            self._metas[segment["first_seq"]] = meta
+            if len(self._metas) > self.META_CACHE_SIZE:
+                self._metas.popitem(last=False)
+        else:
+            self._metas.move_to_end(segment["first_seq"])
+        return meta
+
+    @staticmethod
+    def _read(f, offset: int) -> dict:
+        f.seek(offset)
+        return json.loads(f.readline())
+
+    async def get(self, transaction_id: str) -> Optional[dict]:
+        seq = self._hot_ids.get(transaction_id)
+        if seq is not None:
+            return self._hot[seq]
+        mask = (1 << self.SEGMENT_BITS) - 1
+        prefix = hash(transaction_id) & ~mask
+        numbers = []
+        for run in self._id_runs:
+            i = bisect_left(run, prefix)
+            while i < len(run) and run[i] - prefix <= mask:
+                numbers.append(run[i] - prefix)
+                i += 1
+        # Almost always one segment; its bucket has the exact id
+        for number in sorted(numbers, reverse=True):
+            segment = self._segments[number]
+            offset = self._bucket(segment, transaction_id)["ids"].get(transaction_id)
+            if offset is not None:
+                with open(segment["path"], "rb") as f:
+                    return self._read(f, offset)
+        return None
+
+    def _seq_range(self, segment: dict, hi: int, since: Optional[datetime], until: Optional[datetime]) -> tuple:
+        """[lo, hi) of the segment's seqs below hi within the time range"""
+        first_seq = segment["first_seq"]
+        lo, hi = first_seq, min(hi, first_seq + segment["count"])
+        # Only a segment the range starts or ends in needs its timestamps
+        if (since and since > segment["first_timestamp"]) or (until and until < segment["last_timestamp"]):
+            timestamps = self._meta(segment)["timestamps"]
+            if since:
+                lo = first_seq + bisect_left(timestamps, since)
+            if until:
+                hi = min(hi, first_seq + bisect_right(timestamps, until))
+        return lo, hi
+
+    def _scan(self, hi: int, account: Optional[str], bank: Optional[str],
+              since: Optional[datetime], until: Optional[datetime]):
+        """(seq, record) below hi within the time range, newest first: the hot records, then each segment"""
+        # Walk the most selective index; the account index is used even if a bank is also given
+        kind, key = ("accounts", account) if account is not None else ("banks", bank)
+        hot_start = self._next_seq - len(self._hot)
+        lo = hot_start + (bisect_left(self._hot_timestamps, since) if since else 0)
+        top = min(hi, hot_start + (bisect_right(self._hot_timestamps, until) if until else len(self._hot)))
+        if key is None:
+            for seq in range(top - 1, lo - 1, -1):
+                yield seq, self._hot[seq]
+        else:
+            seqs = (self._hot_accounts if kind == "accounts" else self._hot_banks).get(key, [])
+            for i in range(bisect_left(seqs, top) - 1, bisect_left(seqs, lo) - 1, -1):
+                yield seqs[i], self._hot[seqs[i]]
+        
+        for segment in reversed(self._segments):
+            if since and segment["last_timestamp"] < since:
+                # Segments are in time order, the rest are older still
+                return
+            if segment["first_seq"] >= hi or (until and segment["first_timestamp"] > until):
+                continue
+            if key is None:
+                lo, top = self._seq_range(segment, hi, since, until)
+                offsets = self._meta(segment)["offsets"]
+                with open(segment["path"], "rb") as f:
+                    for seq in range(top - 1, lo - 1, -1):
+                        yield seq, self._read(f, offsets[seq - segment["first_seq"]])
+                continue
+            postings = self._bucket(segment, key)[kind].get(key)
+            if postings is None:
+                continue
+            seqs, offsets = postings
+            lo, top = self._seq_range(segment, hi, since, until)
+            with open(segment["path"], "rb") as f:
+                for i in range(bisect_left(seqs, top) - 1, bisect_left(seqs, lo) - 1, -1):
+                    yield seqs[i], self._read(f, offsets[i])
+
+    async def query(self, limit: int, cursor: Optional[int] = None, account: Optional[str] = None,
+              bank: Optional[str] = None, since: Optional[datetime] = None, until: Optional[datetime] = None):
+        """Newest-first page of records matching every filter; returns (records, next_cursor)"""
+        hi = self._next_seq if cursor is None else min(cursor, self._next_seq)
+        page = []
+        scan = self._scan(hi, account, bank, since, until)
+        try:
+            for seq, record in scan:
+                if bank is not None and bank not in (record["sender_bank"], record["receiver_bank"]):
+                    continue
+                page.append(record)
+                if len(page) == limit:
+                    return page, seq
+        finally:
+            # Closes the segment file a full page stopped in
+            scan.close()
+        return page, None
+
+    def close(self):
+        """Segments only back this process's log, so they are removed on shutdown"""
+        self._metas.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+class SQLiteTransactionStore:
+    """
+    TransactionStore on the shared database. The table's rowid is the
+    sequence number, so cursors work as in memory; the account and bank
+    filters use per-column indexes.
+    """
+
+    def __init__(self, state: SQLiteState):
+        self.state = state
+
+    async def count(self) -> int:
+        # Rows are never deleted, so the last seq is the count
+        return (await self.state.query("SELECT COALESCE(MAX(seq), 0) FROM transactions"))[0][0]
+
+    async def append(self, record: dict) -> dict:
+        """Add a record; a transaction id already in the log is not added twice"""
+        added = await self.state.execute(
+            "INSERT OR IGNORE INTO transactions "
+            "(transaction_id, timestamp, from_account, to_account, sender_bank, receiver_bank, record) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (record["transaction_id"], record["timestamp"], record["from_account"], record["to_account"],
+             record["sender_bank"], record["receiver_bank"], json.dumps(record)),
+            record=True
+        )
+        return record if added else await self.get(record["transaction_id"])
+
+    async def get(self, transaction_id: str) -> Optional[dict]:
+        rows = await self.state.query("SELECT record FROM transactions WHERE transaction_id = ?", (transaction_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def query(self, limit: int, cursor: Optional[int] = None, account: Optional[str] = None,
+              bank: Optional[str] = None, since: Optional[datetime] = None, until: Optional[datetime] = None):
+        """Newest-first page of records matching every filter; returns (records, next_cursor)"""
+        clauses, params = [], []
+        if cursor is not None:
+            clauses.append("seq < ?")
+            params.append(cursor)
+        # Timestamps are stored as naive UTC ISO strings, which sort chronologically
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since.isoformat())
+        if until:
+            clauses.append("timestamp <= ?")
+            params.append(until.isoformat())
+        if account is not None:
+            clauses.append("(from_account = ? OR to_account = ?)")
+            params += [account, account]
+        if bank is not None:
+            clauses.append("(sender_bank = ? OR receiver_bank = ?)")
+            params += [bank, bank]
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        rows = await self.state.query(f"SELECT seq, record FROM transactions {where}ORDER BY seq DESC LIMIT ?", (*params, limit))
+        page = [json.loads(record) for _, record in rows]
+        return page, (rows[-1][0] if len(rows) == limit else None)
+
+    def close(self):
+        pass
+
+if shared_state is not None:
+    transaction_log = SQLiteTransactionStore(shared_state)
+else:
+    transaction_log = TransactionStore(TRANSACTION_LOG_DIR, TRANSACTION_LOG_HOT_LIMIT, TRANSACTION_LOG_SEGMENT_SIZE)
+
+class BankRoute:
+    """One bank in the routing table: its account prefixes and API endpoints"""
+
+    def __init__(self, name: str, prefixes: List[str], endpoints: List[str]):
+        self.name = name
+        self.prefixes = prefixes
+        self.endpoints = endpoints
+        self.clients: List[httpx.AsyncClient] = []
+        # Maintained by the health monitor; unhealthy endpoints are skipped
+        self.healthy = [True] * len(endpoints)
+        self._next = 0
+
+    def next_client(self) -> httpx.AsyncClient:
+        """Round robin over the healthy endpoints (over all of them if none is)"""
+        count = len(self.clients)
+        for _ in range(count):
+            index = self._next % count
+            self._next += 1
+            if self.healthy[index]:
+                return self.clients[index]
+        index = self._next % count
+        self._next += 1
+        return self.clients[index]
+
+class RoutingTable:
+    """
+    Maps account numbers to banks by longest matching prefix. Prefixes are
+    kept in one dict and tried from the longest length down, so resolving
+    costs one lookup per distinct prefix length, however many banks there are.
+    """
+
+    def __init__(self, routes: Dict[str, BankRoute]):
+        self.routes = routes
+        self._banks_by_prefix: Dict[str, str] = {}
+        for route in routes.values():
+            for prefix in route.prefixes:
+                if prefix in self._banks_by_prefix:
+                    raise ValueError(f"Prefix {prefix!r} is assigned to both {self._banks_by_prefix[prefix]} and {route.name}")
+                self._banks_by_prefix[prefix] = route.name
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._banks_by_prefix}, reverse=True)
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RoutingTable":
+        routes = {}
+        for name, bank in config["banks"].items():
+            endpoints = bank.get("endpoints") or []
+            if not endpoints:
+                raise ValueError(f"Bank {name} has no endpoints")
+            routes[name] = BankRoute(name, bank.get("prefixes") or [name], endpoints)
+        return cls(routes)
+
+    def resolve(self, account_number: str) -> Optional[str]:
+        for length in self._prefix_lengths:
+            bank_name = self._banks_by_prefix.get(account_number[:length])
+            if bank_name is not None:
+                return bank_name
+        return None
+
+class BankClientRegistry:
+    """
+    The routing table plus one long-lived, keep-alive httpx client per bank
+    endpoint. With GATEWAY_ROUTES_PATH set, the file is re-read whenever it
+    changes; clients of endpoints that are still listed are kept.
+    """
+
+    def __init__(self, routes_path: Optional[str]):
+        self.routes_path = routes_path
+        self.table = RoutingTable({})
+        self._clients: Dict[str, httpx.AsyncClient] = {}  # endpoint url -> client
+        self._retired: set = set()
+        self._mtime = None
+        self._watcher: Optional[asyncio.Task] = None
+        self.reloads = 0
+
+    def _http2_available(self) -> bool:
+        if not BANK_HTTP2:
+            return False
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            print("⚠️ BANK_HTTP2 is enabled but the 'h2' package is missing, using HTTP/1.1")
+            return False
+
+    async def start(self):
+        self._http2 = self._http2_available()
+        self.load()
+        if self.routes_path:
+            self._watcher = asyncio.create_task(self._watch())
+
+    def _new_client(self, url: str) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=url,
+            limits=httpx.Limits(
+                max_connections=BANK_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=BANK_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=BANK_HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(BANK_HTTP_TIMEOUT, connect=BANK_HTTP_CONNECT_TIMEOUT),
+            http2=self._http2
+        )
+
+    def load(self):
+        """Build and swap in a new routing table; raises (keeping the old one) if the config is invalid"""
+        if self.routes_path:
+            mtime = os.stat(self.routes_path).st_mtime_ns
+            with open(self.routes_path, "r", encoding="utf-8") as f:
+                table = RoutingTable.from_config(json.load(f))
+        else:
+            mtime = None
+            table = RoutingTable.from_config(DEFAULT_ROUTES)
+        
+        for route in table.routes.values():
+            for url in route.endpoints:
+                if url not in self._clients:
+                    self._clients[url] = self._new_client(url)
+            route.clients = [self._clients[url] for url in route.endpoints]
+            circuit_breakers.setdefault(route.name, CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS))
+        
+        self.table = table
+        self._mtime = mtime
+        self.reloads += 1
+        
+        # Endpoints dropped from the table may still have requests in flight
+        in_use = {url for route in table.routes.values() for url in route.endpoints}
+        for url in [url for url in self._clients if url not in in_use]:
+            task = asyncio.create_task(self._close_later(self._clients.pop(url)))
+            self._retired.add(task)
+            task.add_done_callback(self._retired.discard)
+
+    async def _close_later(self, client: httpx.AsyncClient):
+        try:
+            await asyncio.sleep(BANK_HTTP_TIMEOUT)
+        finally:
+            await client.aclose()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(ROUTES_RELOAD_INTERVAL)
+            try:
+                mtime = os.stat(self.routes_path).st_mtime_ns
+                if mtime == self._mtime:
+                    continue
+                # A broken file is reported once, not on every poll
+                self._mtime = mtime
+                self.load()
+                print(f"🔁 Routing table reloaded: {len(self.table.routes)} bank(s)")
+            except Exception as e:
+                print(f"❌ Routing table reload failed, keeping the current one: {e}")
+
+    def resolve(self, account_number: str) -> Optional[str]:
+        return self.table.resolve(account_number)
+
+    def banks(self) -> List[str]:
+        return list(self.table.routes)
+
+    def get(self, bank_name: str) -> httpx.AsyncClient:
+        route = self.table.routes.get(bank_name)
+        if route is None:
+            raise RuntimeError(f"No route configured for {bank_name}")
+        return route.next_client()
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        retired = list(self._retired)
+        for task in retired:
+            task.cancel()
+        await asyncio.gather(*retired, return_exceptions=True)
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+bank_clients = BankClientRegistry(GATEWAY_ROUTES_PATH)
+
+class BankUnavailableError(Exception):
+    """Raised instead of calling a bank whose circuit is open"""
+
+class DeadlineExceededError(Exception):
+    """Raised instead of calling a bank once the transfer's time budget is spent"""
+
+# Monotonic deadline of the transfer being processed; tasks started from a
+# request inherit it, so every bank call of the transfer shares one budget
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+class CircuitBreaker:
+    """
+    closed: calls go through; CIRCUIT_FAILURE_THRESHOLD consecutive
+    failures (transport errors or 5xx) open the circuit.
+    open: calls fail immediately until reset_seconds have passed, then
+    the circuit is half-open.
+    half_open: one trial call at a time; success closes the circuit,
+    failure opens it again. Only used from the event loop.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.rejected = 0
+
+    def ready(self) -> bool:
+        """Whether allow() would let a call through now, without taking the half-open trial"""
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+        return self.state == "closed" or (self.state == "half_open" and not self.trial_in_flight)
+
+    def allow(self) -> bool:
+        if not self.ready():
+            self.rejected += 1
+            return False
+        if self.state == "half_open":
+            self.trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"⚡ Circuit opened after {self.failures} consecutive failure(s)")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """The call was cancelled before it produced an outcome"""
+        self.trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures, "rejected": self.rejected}
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}  # filled in as banks are added to the routing table
+
+class BankHealthMonitor:
+    """
+    Probes every endpoint of every bank concurrently each interval and
+    keeps the result, so /health and transfer routing read cached state
+    instead of calling the banks. Endpoint results steer load balancing;
+    a bank is connected while any of its endpoints is. A bank that is not
+    counts as a failure for its circuit breaker, but a good probe does
+    not close the circuit: "/" may answer while transfers fail, so
+    recovery is left to the breaker's half-open trial.
+    """
+
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.status: Dict[str, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _probe(self, route: BankRoute, index: int) -> dict:
+        start = time.perf_counter()
+        try:
+            response = await route.clients[index].get("/", timeout=self.timeout)
+            status = "connected" if response.status_code == 200 else "error"
+        except Exception:
+            status = "disconnected"
+        route.healthy[index] = status == "connected"
+        return {
+            "endpoint": route.endpoints[index],
+            "status": status,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1)
+        }
+
+    async def check_all(self):
+        routes = list(bank_clients.table.routes.values())
+        probes = [(route, index) for route in routes for index in range(len(route.endpoints))]
+        results = await asyncio.gather(*(self._probe(route, index) for route, index in probes))
+        checked_at = datetime.utcnow().isoformat()
+        
+        status = {}
+        for route in routes:
+            endpoints = [result for (r, _), result in zip(probes, results) if r is route]
+            if any(e["status"] == "connected" for e in endpoints):
+                bank_status = "connected"
+            elif any(e["status"] == "error" for e in endpoints):
+                bank_status = "error"
+            else:
+                bank_status = "disconnected"
+            breaker = circuit_breakers[route.name]
+            if bank_status != "connected" and breaker.state != "open":
+                breaker.record_failure()
+            status[route.name] = {"status": bank_status, "checked_at": checked_at, "endpoints": endpoints}
+        self.status = status
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check_all()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def available(self, bank_name: str) -> bool:
+        """
+        Pre-check before a transfer calls the bank. The circuit breaker
+        decides, so a bank is tried again once CIRCUIT_RESET_SECONDS have
+        passed, whatever the last probe said
+        """
+        breaker = circuit_breakers.get(bank_name)
+        return breaker is None or breaker.ready()
+
+health_monitor = BankHealthMonitor(HEALTH_CHECK_INTERVAL, HEALTH_CHECK_TIMEOUT)
+
+class IdempotencyStore:
+    """
+    Results of keyed transfers. A key is either in flight (later callers
+    await the first execution) or finished (callers get the stored
+    response). Only final outcomes are stored: a transient one (see
+    transient()) goes to the waiters and frees the key for a retry.
+    Finished entries expire after ttl and the oldest are dropped beyond
+    max_keys. Only used from the event loop; the methods are coroutines to
+    match SQLiteIdempotencyStore.
+    """
+
+    def __init__(self, ttl: float, max_keys: int):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._in_flight: Dict[str, tuple] = {}  # key -> (fingerprint, future)
+        self._results: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (fingerprint, response, expires_at)
+        self.replays = 0
+
+    async def _evict(self):
+        now = time.monotonic()
+        # Every entry has the same ttl, so insertion order is expiry order
+        while self._results:
+            key, (_, _, expires_at) = next(iter(self._results.items()))
+            if expires_at > now and len(self._results) <= self.max_keys:
+                break
+            self._results.popitem(last=False)
+
+    async def lookup(self, key: str, fingerprint: str):
+        """Stored response, a future to await, or None if the key is new"""
+        await self._evict()
+        entry = self._in_flight.get(key) or self._results.get(key)
+        if entry is None:
+            return None
+        if entry[0] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency key was already used for a different transfer")
+        self.replays += 1
+        return entry[1]
+
+    async def begin(self, key: str, fingerprint: str):
+        """Claim a key that lookup() found new; returns None once claimed"""
+        self._in_flight[key] = (fingerprint, asyncio.get_running_loop().create_future())
+        return None
+
+    async def complete(self, key: str, response):
+        """Hand the response to waiters; only a final outcome is kept, a transient one frees the key"""
+        fingerprint, future = self._in_flight.pop(key)
+        future.set_result(response)
+        if not response._transient:
+            await self.remember(key, fingerprint, response)
+
+    async def remember(self, key: str, fingerprint: str, response):
+        """Store a final outcome, also for a key no request holds (a transfer the compensator settled)"""
+        self._results[key] = (fingerprint, response, time.monotonic() + self.ttl)
+        self._results.move_to_end(key)
+        await self._evict()
+
+    async def abandon(self, key: str, error: BaseException):
+        """The first execution crashed; waiters see the error and the key can be retried"""
+        _, future = self._in_flight.pop(key)
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(error)
+            # Nobody may be waiting; avoid "exception was never retrieved" warnings
+            future.exception()
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "stored": len(self._results),
+            "replays": self.replays
+        }
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """
+    IdempotencyStore on the shared database. Inserting the key's row
+    claims it, so one worker executes the transfer and the others poll the
+    row until the owner stores the response or gives the key up. Until
+    then the row's expires_at is a lease the owner keeps renewing; a key
+    whose lease has run out (its worker died) counts as given up.
+    """
+
+    def __init__(self, state: SQLiteState, ttl: float, max_keys: int, lease: float):
+        super().__init__(ttl, max_keys)
+        self.state = state
+        self.lease = lease
+        self._next_prune = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            keys = list(self._in_flight)
+            try:
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    await self.state.execute(
+                        f"UPDATE idempotency SET expires_at = ? WHERE response IS NULL AND owner = ? "
+                        f"AND key IN ({', '.join('?' * len(chunk))})",
+                        (time.time() + self.lease, os.getpid(), *chunk)
+                    )
+            except Exception as e:
+                # Tried again on the next round, well before the lease runs out
+                print(f"⚠️ Idempotency lease renewal failed: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._renew())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _evict(self):
+        now = time.time()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + SHARED_STATE_PRUNE_INTERVAL
+        # Stored responses past their ttl and keys whose lease ran out
+        await self.state.execute("DELETE FROM idempotency WHERE expires_at <= ?", (now,))
+        await self.state.execute(
+            "DELETE FROM idempotency WHERE key IN (SELECT key FROM idempotency WHERE response IS NOT NULL "
+            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_keys,)
+        )
+
+    async def _entry(self, key: str, fingerprint: str):
+        rows = await self.state.query(
+            "SELECT fingerprint, response FROM idempotency WHERE key = ? AND expires_at > ?",
+            (key, time.time())
+        )
+        if not rows:
+            return None
+        stored_fingerprint, response = rows[0]
+        if stored_fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency key was already used for a different transfer")
+        if response is not None:
+            return TransferResponse(**json.loads(response))
+        if key in self._in_flight:
+            return self._in_flight[key][1]
+        task = asyncio.ensure_future(self._wait_for_owner(key))
+        # The caller may not wait (async mode); don't warn about an unretrieved error
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _wait_for_owner(self, key: str) -> "TransferResponse":
+        while True:
+            await asyncio.sleep(SHARED_STATE_POLL_INTERVAL)
+            rows = await self.state.query("SELECT response, expires_at FROM idempotency WHERE key = ?", (key,))
+            if rows and rows[0][0] is not None:
+                return TransferResponse(**json.loads(rows[0][0]))
+            if rows and rows[0][1] <= time.time():
+                # The owner stopped renewing its lease; free the key for the retry
+                await self.state.execute(
+                    "DELETE FROM idempotency WHERE key = ? AND response IS NULL AND expires_at <= ?",
+                    (key, time.time())
+                )
+            elif rows:
+                continue
+            raise HTTPException(status_code=409, detail="The first request with this idempotency key did not finish, retry it")
+
+    async def lookup(self, key: str, fingerprint: str):
+        """Stored response, an awaitable, or None if the key is new"""
+        await self._evict()
+        entry = await self._entry(key, fingerprint)
+        if entry is not None:
+            self.replays += 1
+        return entry
+
+    async def begin(self, key: str, fingerprint: str):
+        """Claim the key; if another worker got there first, returns what lookup() would"""
+        def claim(conn):
+            conn.execute("DELETE FROM idempotency WHERE key = ? AND expires_at <= ?", (key, time.time()))
+            return conn.execute(
+                "INSERT OR IGNORE INTO idempotency (key, fingerprint, response, owner, expires_at) "
+                "VALUES (?, ?, NULL, ?, ?)",
+                (key, fingerprint, os.getpid(), time.time() + self.lease)
+            ).rowcount
+        while True:
+            if await self.state.transaction(claim):
+                return await super().begin(key, fingerprint)
+            entry = await self.lookup(key, fingerprint)
+            if entry is not None:
+                return entry
+
+    async def complete(self, key: str, response):
+        # Stored even when the transfer has moved money; waiting for the write lock beats losing the outcome
+        if response._transient:
+            # Waiting workers see the key given up and retry it
+            await self.state.execute("DELETE FROM idempotency WHERE key = ? AND response IS NULL", (key,), record=True)
+        else:
+            await self.state.execute(
+                "UPDATE idempotency SET response = ?, expires_at = ? WHERE key = ?",
+                (json.dumps(jsonable_encoder(response)), time.time() + self.ttl, key),
+                record=True
+            )
+        _, future = self._in_flight.pop(key)
+        future.set_result(response)
+
+    async def remember(self, key: str, fingerprint: str, response):
+        await self.state.execute(
+            "INSERT INTO idempotency (key, fingerprint, response, owner, expires_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET response = excluded.response, expires_at = excluded.expires_at",
+            (key, fingerprint, json.dumps(jsonable_encoder(response)), os.getpid(), time.time() + self.ttl),
+            record=True
+        )
+
+    async def abandon(self, key: str, error: BaseException):
+        try:
+            await self.state.execute("DELETE FROM idempotency WHERE key = ? AND response IS NULL", (key,), record=True)
+        finally:
+            await super().abandon(key, error)
+
+    async def stats(self) -> dict:
+        in_flight, stored = (await self.state.query("SELECT COUNT(*) - COUNT(response), COUNT(response) FROM idempotency"))[0]
+        return {
+            "in_flight": in_flight,
+            "stored": stored,
+            "replays": self.replays
+        }
+
+if shared_state is not None:
+    idempotency_store = SQLiteIdempotencyStore(shared_state, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_LEASE_SECONDS)
+else:
+    idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS)
+
+class TokenBucketLimiter:
+    """
+    Token bucket per key: refills at rate tokens per second up to burst,
+    each request takes one. Buckets are refilled lazily on access; the
+    least recently used are dropped beyond max_keys (a dropped key starts
+    again with a full bucket).
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, updated_at]
+
+    async def acquire(self, key: str, now: float) -> float:
+        """Take a token; returns 0 if admitted, else seconds until one is available"""
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return self._take(bucket, now)
+
+    def _take(self, bucket: list, now: float) -> float:
+        """Refill a [tokens, updated_at] bucket up to now and take a token from it"""
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    async def refund(self, key: str, now: float):
+        """Give back the token acquire() took for a request rejected by a later check"""
+        bucket = self._buckets.get(key)
+        if self.rate > 0 and bucket is not None:
+            self._give_back(bucket, now)
+
+    def _give_back(self, bucket: list, now: float):
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate + 1)
+        bucket[1] = now
+
+    async def size(self) -> int:
+        return len(self._buckets)
+
+class SQLiteTokenBucketLimiter(TokenBucketLimiter):
+    """TokenBucketLimiter with its buckets in the shared database; each acquire is one transaction"""
+
+    def __init__(self, state: SQLiteState, name: str, rate: float, burst: float):
+        super().__init__(rate, burst, 0)
+        self.state = state
+        self.name = name
+        self._next_prune = 0.0
+
+    async def acquire(self, key: str, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        if now >= self._next_prune:
+            self._next_prune = now + SHARED_STATE_PRUNE_INTERVAL
+            # After burst / rate idle seconds a bucket is full again, the same as a missing one
+            await self.state.prune_limiter(self.name, now - self.burst / self.rate)
+        return await self.state.update_limiter(self.name, key, now, [self.burst, now], lambda bucket: self._take(bucket, now))
+
+    async def refund(self, key: str, now: float):
+        if self.rate > 0:
+            await self.state.update_limiter(self.name, key, now, [self.burst, now], lambda bucket: self._give_back(bucket, now))
+
+    async def size(self) -> int:
+        return await self.state.count_limiter(self.name)
+
+class VelocityLimiter:
+    """
+    Transfer count and amount per key over a sliding window. The window is
+    estimated from the current and previous fixed windows, weighting the
+    previous one by how much of it the sliding window still covers, so
+    each key needs five numbers and each check is O(1).
+    """
+
+    def __init__(self, window: float, max_count: int, max_amount: float, max_keys: int):
+        self.window = window
+        self.max_count = max_count
+        self.max_amount = max_amount
+        self.max_keys = max_keys
+        # key -> [window index, count, amount, previous window's count, previous window's amount]
+        self._windows: "OrderedDict[str, list]" = OrderedDict()
+
+    async def add(self, key: str, amount: float, now: float, count: int = 1) -> float:
+        """
+        Count count transfers totalling amount; returns 0 if within the
+        limits, else seconds until the window moves on (infinite if the
+        amount alone is over the limit)
+        """
+        if not self.max_count and not self.max_amount:
+            return 0.0
+        if self.max_amount and amount > self.max_amount:
+            return math.inf
+        entry = self._windows.get(key)
+        if entry is None:
+            entry = self._windows[key] = [int(now // self.window), 0, 0.0, 0, 0.0]
+            if len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(key)
+        return self._count(entry, amount, now, count)
+
+    def _count(self, entry: list, amount: float, now: float, count: int = 1) -> float:
+        """Move the key's windows up to now and count the transfers if they fit"""
+        index = int(now // self.window)
+        if entry[0] != index:
+            previous = entry[1:3] if entry[0] == index - 1 else [0, 0.0]
+            entry[:] = [index, 0, 0.0, *previous]
+        
+        previous_weight = 1 - (now - index * self.window) / self.window
+        counted = entry[1] + entry[3] * previous_weight
+        total = entry[2] + entry[4] * previous_weight
+        if (self.max_count and counted + count > self.max_count) or (self.max_amount and total + amount > self.max_amount):
+            return (index + 1) * self.window - now
+        entry[1] += count
+        entry[2] += amount
+        return 0.0
+
+    async def size(self) -> int:
+        return len(self._windows)
+
+class SQLiteVelocityLimiter(VelocityLimiter):
+    """VelocityLimiter with its windows in the shared database; each add is one transaction"""
+
+    def __init__(self, state: SQLiteState, name: str, window: float, max_count: int, max_amount: float):
+        super().__init__(window, max_count, max_amount, 0)
+        self.state = state
+        self.name = name
+        self._next_prune = 0.0
+
+    async def add(self, key: str, amount: float, now: float, count: int = 1) -> float:
+        if not self.max_count and not self.max_amount:
+            return 0.0
+        if self.max_amount and amount > self.max_amount:
+            return math.inf
+        if now >= self._next_prune:
+            self._next_prune = now + SHARED_STATE_PRUNE_INTERVAL
+            # Counts older than the previous window no longer matter
+            await self.state.prune_limiter(self.name, now - 2 * self.window)
+        initial = [int(now // self.window), 0, 0.0, 0, 0.0]
+        return await self.state.update_limiter(self.name, key, now, initial, lambda entry: self._count(entry, amount, now, count))
+
+    async def size(self) -> int:
+        return await self.state.count_limiter(self.name)
+
+class AdmissionController:
+    """
+    Rate and velocity checks for one transfer, only used from the event
+    loop. Limits are kept in memory, or in the shared database so that
+    they hold across all workers; the counters are this worker's.
+    """
+
+    def __init__(self, state: Optional[SQLiteState] = None):
+        if state is None:
+            self.client_limiter = TokenBucketLimiter(RATE_LIMIT_CLIENT_RPS, RATE_LIMIT_CLIENT_BURST, ADMISSION_MAX_KEYS)
+            self.account_limiter = TokenBucketLimiter(RATE_LIMIT_ACCOUNT_RPS, RATE_LIMIT_ACCOUNT_BURST, ADMISSION_MAX_KEYS)
+            self.velocity = VelocityLimiter(VELOCITY_WINDOW_SECONDS, VELOCITY_MAX_COUNT, VELOCITY_MAX_AMOUNT, ADMISSION_MAX_KEYS)
+        else:
+            self.client_limiter = SQLiteTokenBucketLimiter(state, "client", RATE_LIMIT_CLIENT_RPS, RATE_LIMIT_CLIENT_BURST)
+            self.account_limiter = SQLiteTokenBucketLimiter(state, "account", RATE_LIMIT_ACCOUNT_RPS, RATE_LIMIT_ACCOUNT_BURST)
+            self.velocity = SQLiteVelocityLimiter(state, "velocity", VELOCITY_WINDOW_SECONDS, VELOCITY_MAX_COUNT, VELOCITY_MAX_AMOUNT)
+        self.admitted = 0
+        self.rejected = {"client_rate": 0, "account_rate": 0, "velocity": 0}
+
+    async def check_client(self, client: str) -> Optional[tuple]:
+        """None if admitted, else (reason, retry_after_seconds)"""
+        # Wall clock, which every worker process agrees on
+        retry_after = await self.client_limiter.acquire(client, time.time())
+        if retry_after:
+            self.rejected["client_rate"] += 1
+            return "Too many requests from this client", retry_after
+        return None
+
+    async def check_account(self, account_number: str, amount: float, count: int = 1) -> Optional[tuple]:
+        """
+        None if admitted, else (reason, retry_after_seconds). A batch's
+        count items from one sender, totalling amount, take a single
+        rate-limit token and are counted together against the velocity limits
+        """
+        now = time.time()
+        retry_after = await self.account_limiter.acquire(account_number, now)
+        if retry_after:
+            self.rejected["account_rate"] += 1
+            return "Too many transfers from this account", retry_after
+        retry_after = await self.velocity.add(account_number, amount, now, count)
+        if retry_after:
+            # Not admitted, so it shouldn't hold back the account's next request either
+            await self.account_limiter.refund(account_number, now)
+            self.rejected["velocity"] += 1
+            return "Transfer count or amount limit reached for this account", retry_after
+        self.admitted += 1
+        return None
+
+    async def stats(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "tracked_clients": await self.client_limiter.size(),
+            "tracked_accounts": await self.velocity.size()
+        }
+
+admission = AdmissionController(shared_state)
+
+class TransferWAL:
+    """
+    Append-only JSON-lines log of cross-bank transfer states:
+    started -> authorized -> debited -> credited, or
+    debited -> compensating -> compensated, or aborted before any debit.
+    record() only queues the line; one flush task writes and fsyncs
+    everything queued so far, so concurrent transfers share a sync.
+    Transfers not yet in a final state are kept in memory for the
+    compensator and are what startup recovery resumes.
+    Each worker process holds an exclusive lock on its own log: the first
+    takes the configured path, others use "<path>.<pid>". A worker also
+    adopts any per-process log whose owner has died. Without flock
+    (Windows) there are no per-process logs: a second worker on the same
+    path refuses to start rather than rewrite the first one's log.
+    """
+    FINAL_STATES = ("credited", "compensated", "aborted")
+
+    def __init__(self, path: str, fsync: bool, compact_records: int):
+        self.base_path = path
+        self.path = path
+        self._lock = None
+        self.fsync = fsync
+        self.compact_records = compact_records
+        self.transfers: Dict[str, dict] = {}  # transaction_id -> latest state and details
+        self._file = None
+        self._pending: List[tuple] = []  # (line, future)
+        self._flusher: Optional[asyncio.Task] = None
+        self._records_since_compaction = 0
+        self.flushes = 0
+        self.records = 0
+
+    def open(self) -> List[dict]:
+        """Replay this worker's log and any orphaned ones, rewrite it with only unfinished transfers, return those"""
+        self._claim()
+        orphans = self._orphans()
+        for path in [self.path] + [path for path, _ in orphans]:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn final write from a crash; it was never acknowledged
+                        print(f"⚠️ Ignoring incomplete WAL record at end of {path}")
+                        break
+                    self._apply(record)
+        self._compact([json.dumps(entry) for entry in self.transfers.values()])
+        # Adopted transfers are now durable in this worker's log
+        for path, lock in orphans:
+            print(f"📒 Adopted WAL {path} from a worker that is gone")
+            self._remove(path, lock)
+        return list(self.transfers.values())
+
+    @staticmethod
+    def _try_lock(path: str):
+        """Exclusive lock on path's lock file, or None if a live process holds it"""
+        lock = open(path + ".lock", "a")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # A lock file deleted by the worker that adopted its log protects nothing
+            current = os.stat(path + ".lock").st_ino == os.fstat(lock.fileno()).st_ino
+        except (BlockingIOError, FileNotFoundError):
+            current = False
+        if not current:
+            lock.close()
+            return None
+        return lock
+
+    def _claim(self):
+        if fcntl is None:
+            self._claim_single()
+            return
+        self._lock = self._try_lock(self.base_path)
+        if self._lock is None:
+            self.path = f"{self.base_path}.{os.getpid()}"
+            self._lock = self._try_lock(self.path)
+            if self._lock is None:
+                raise RuntimeError(f"Could not lock {self.path}")
+
+    def _claim_single(self):
+        """Lock the configured path for this process, without taking over logs of dead workers"""
+        if msvcrt is None:
+            return
+        lock = open(self.base_path + ".lock", "a+")
+        lock.seek(0)
+        try:
+            # Released by Windows when the process exits, however it exits
+            msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock.close()
+            raise RuntimeError(
+                f"{self.base_path} is in use by another gateway worker. Without flock each worker needs "
+                "its own GATEWAY_WAL_PATH; run a single worker, or one process per WAL path"
+            )
+        self._lock = lock
+
+    def _orphans(self) -> List[tuple]:
+        """(path, lock) for each per-process log whose worker is gone"""
+        if fcntl is None:
+            return []
+        orphans = []
+        prefix = self.base_path + "."
+        for path in glob.glob(glob.escape(prefix) + "*"):
+            if path == self.path or not path[len(prefix):].isdigit():
+                continue
+            lock = self._try_lock(path)
+            if lock is not None:
+                orphans.append((path, lock))
+        return orphans
+
+    @staticmethod
+    def _remove(path: str, lock):
+        # The log goes first: whoever locks the lock file next finds nothing to adopt
+        for name in (path, path + ".lock"):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+        lock.close()
+
+    def _apply(self, record: dict):
+        transaction_id = record["transaction_id"]
+        if record["state"] in self.FINAL_STATES:
+            self.transfers.pop(transaction_id, None)
+        else:
+            self.transfers.setdefault(transaction_id, {}).update(record)
+
+    def _compact(self, lines: List[str]):
+        if self._file is not None:
+            self._file.close()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._records_since_compaction = 0
+
+    def record(self, transaction_id: str, state: str, **fields) -> asyncio.Future:
+        """Queue a state change; await the returned future to wait until it is on disk"""
+        record = {"transaction_id": transaction_id, "state": state, "at": datetime.utcnow().isoformat(), **fields}
+        self._apply(record)
+        future = asyncio.get_running_loop().create_future()
+        # Write errors are reported by the flusher; callers that don't wait need not see them
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending.append((json.dumps(record), future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+        return future
+
+    async def _flush(self):
+        while self._pending:
+            batch, self._pending = self._pending, []
+            error = None
+            try:
+                await asyncio.to_thread(self._write, [line for line, _ in batch])
+                self.flushes += 1
+                self.records += len(batch)
+                self._records_since_compaction += len(batch)
+                if self._records_since_compaction >= self.compact_records:
+                    # Snapshot on the event loop; the lines still queued are replayed on top of it
+                    snapshot = [json.dumps(entry) for entry in self.transfers.values()]
+                    await asyncio.to_thread(self._compact, snapshot)
+            except Exception as e:
+                print(f"❌ WAL write failed: {e}")
+                error = e
+            for _, future in batch:
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    def _write(self, lines: List[str]):
+        self._file.write("".join(line + "\n" for line in lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    async def close(self):
+        if self._flusher is not None:
+            await self._flusher
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock is not None:
+            if self.path != self.base_path and not self.transfers:
+                # Nothing left to resume from a per-process log
+                self._remove(self.path, self._lock)
+            else:
+                self._lock.close()
+            self._lock = None
 
-# Transaction log
-transaction_log = []
+    def stats(self) -> dict:
+        states: Dict[str, int] = {}
+        for entry in self.transfers.values():
+            states[entry["state"]] = states.get(entry["state"], 0) + 1
+        return {
+            "path": self.path,
+            "fsync": self.fsync,
+            "flushes": self.flushes,
+            "records": self.records,
+            "avg_records_per_flush": self.records / self.flushes if self.flushes else 0.0,
+            "unfinished": states
+        }
+
+transfer_wal = TransferWAL(GATEWAY_WAL_PATH, GATEWAY_WAL_FSYNC, GATEWAY_WAL_COMPACT_RECORDS)
 
 # Models
 class TransferRequest(BaseModel):
@@ -34,130 +1696,745 @@ class TransferRequest(BaseModel):
     amount: float
     token: str
     description: Optional[str] = ""
+    idempotency_key: Optional[str] = None
 
 class TransferResponse(BaseModel):
     success: bool
     transaction_id: Optional[str] = None
     message: str
     details: Optional[dict] = None
+    # Set by transient(); such outcomes are not stored under an idempotency key
+    _transient: bool = False
+
+class BatchTransferRequest(BaseModel):
+    transfers: List[TransferRequest]
+
+class BatchTransferResponse(BaseModel):
+    total: int
+    succeeded: int
+    failed: int
+    results: List[TransferResponse]
 
 # Helper functions
+async def bank_post(bank: str, path: str, **kwargs) -> httpx.Response:
+    """
+    POST to a bank's API through its circuit breaker, within the current
+    deadline; timed by bank, path and outcome (status code, timeout, error,
+    cancelled, circuit_open or deadline_exceeded)
+    """
+    breaker = circuit_breakers[bank]
+    start = time.perf_counter()
+    # Timeouts caused by a short remaining budget are not held against the bank
+    budget_limited = False
+    deadline = request_deadline.get()
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            BANK_CALL_SECONDS.observe(0.0, bank, path, "deadline_exceeded")
+            raise DeadlineExceededError(f"Transfer deadline exceeded before calling {bank}")
+        if remaining < BANK_HTTP_TIMEOUT:
+            kwargs["timeout"] = remaining
+            budget_limited = True
+    if not breaker.allow():
+        BANK_CALL_SECONDS.observe(time.perf_counter() - start, bank, path, "circuit_open")
+        raise BankUnavailableError(f"{bank} is unavailable (circuit open)")
+    outcome = "error"
+    try:
+        response = await bank_clients.get(bank).post(path, **kwargs)
+        outcome = str(response.status_code)
+    except httpx.TimeoutException:
+        outcome = "timeout"
+        if budget_limited:
+            breaker.release()
+        else:
+            breaker.record_failure()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    except BaseException:
+        # Cancelled, e.g. the losing copy of a hedged request
+        outcome = "cancelled"
+        breaker.release()
+        raise
+    finally:
+        BANK_CALL_SECONDS.observe(time.perf_counter() - start, bank, path, outcome)
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+async def call_bank(bank: str, path: str, retry: bool = False, hedge: bool = False, **kwargs) -> httpx.Response:
+    """
+    bank_post with retries and hedging, within the current deadline.
+    retry: the call is safe to repeat; transport errors and 5xx responses
+    are retried up to BANK_RETRY_ATTEMPTS times after a jittered backoff.
+    hedge: also send a second copy after BANK_HEDGE_DELAY (reads only).
+    """
+    attempts = 1 + (BANK_RETRY_ATTEMPTS if retry else 0)
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        try:
+            if hedge and BANK_HEDGE_DELAY > 0:
+                response = await hedged_bank_post(bank, path, **kwargs)
+            else:
+                response = await bank_post(bank, path, **kwargs)
+            if response.status_code < 500 or last_attempt:
+                return response
+        except (BankUnavailableError, DeadlineExceededError):
+            raise
+        except Exception:
+            if last_attempt:
+                raise
+        delay = random.uniform(0, BANK_RETRY_BASE_DELAY * 2 ** attempt)
+        deadline = request_deadline.get()
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            raise DeadlineExceededError(f"Transfer deadline exceeded while retrying {bank}")
+        await asyncio.sleep(delay)
+
+async def hedged_bank_post(bank: str, path: str, **kwargs) -> httpx.Response:
+    """Start a second identical call if the first is slow; first good answer wins"""
+    pending = {asyncio.create_task(bank_post(bank, path, **kwargs))}
+    failed = None
+    try:
+        done, pending = await asyncio.wait(pending, timeout=BANK_HEDGE_DELAY)
+        if done:
+            return done.pop().result()
+        pending.add(asyncio.create_task(bank_post(bank, path, **kwargs)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code < 500:
+                    return task.result()
+                failed = task
+        # Both copies failed: surface the last error or 5xx response
+        return failed.result()
+    finally:
+        # Also when the caller is cancelled, e.g. at its deadline: no call outlives it
+        for task in pending:
+            task.cancel()
+
+def observe_stage(stage: str, started: float, ok) -> float:
+    """Record a transfer stage that began at started; returns now, the next stage's start"""
+    now = time.perf_counter()
+    TRANSFER_STAGE_SECONDS.observe(now - started, stage, "success" if ok else "failure")
+    return now
+
 def identify_bank(account_number: str) -> Optional[str]:
     """Identify which bank the account belongs to"""
-    if account_number.startswith("BANK1"):
-        return "BANK1"
-    elif account_number.startswith("BANK2"):
-        return "BANK2"
-    return None
+    return bank_clients.resolve(account_number)
 
-async def verify_account_with_bank(bank_url: str, account_number: str) -> dict:
+async def verify_account_with_bank(bank: str, account_number: str) -> dict:
     """Verify account exists with the bank"""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"{bank_url}/verify-account",
-                json={"account_number": account_number},
-                timeout=10.0
-            )
-            return response.json()
-        except Exception as e:
-            return {"exists": False, "error": str(e)}
+    try:
+        response = await call_bank(
+            bank,
+            "/verify-account",
+            retry=True,
+            hedge=True,
+            json={"account_number": account_number}
+        )
+        if response.status_code >= 500:
+            return {"exists": False, "error": f"{bank} returned {response.status_code}", "retryable": True}
+        return response.json()
+    except Exception as e:
+        return {"exists": False, "error": str(e), "retryable": True}
 
-async def authorize_with_sender_bank(bank_url: str, from_account: str, amount: float, token: str) -> dict:
-    """Authorize transaction with sender's bank"""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"{bank_url}/authorize-transfer",
-                json={
-                    "from_account": from_account,
-                    "amount": amount,
-                    "token": token
-                },
-                timeout=10.0
-            )
-            return response.json()
-        except Exception as e:
-            return {"authorized": False, "reason": str(e)}
+async def prepare_with_sender_bank(bank: str, from_account: str, amount: float, token: str) -> dict:
+    """Verify sender account, authorize token and hold funds with sender's bank"""
+    try:
+        response = await bank_post(
+            bank,
+            "/prepare-transfer",
+            json={
+                "from_account": from_account,
+                "amount": amount,
+                "token": token
+            }
+        )
+        if response.status_code >= 500:
+            return {"prepared": False, "exists": None, "reason": f"{bank} returned {response.status_code}", "retryable": True}
+        return response.json()
+    except Exception as e:
+        return {"prepared": False, "exists": None, "reason": str(e), "retryable": True}
 
-async def debit_account(bank_url: str, account_number: str, amount: float, transaction_id: str) -> dict:
+async def release_hold(bank: str, hold_id: str) -> dict:
+    """Release funds held by prepare-transfer"""
+    try:
+        response = await bank_post(
+            bank,
+            "/release-hold",
+            params={"hold_id": hold_id}
+        )
+        return response.json()
+    except Exception as e:
+        return {"success": False, "reason": str(e)}
+
+async def debit_account(bank: str, account_number: str, amount: float, transaction_id: str, hold_id: Optional[str] = None) -> dict:
     """Debit amount from sender's account"""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"{bank_url}/debit",
-                params={
-                    "account_number": account_number,
-                    "amount": amount,
-                    "transaction_id": transaction_id
-                },
-                timeout=10.0
-            )
-            return response.json()
-        except Exception as e:
-            return {"success": False, "reason": str(e)}
+    params = {
+        "account_number": account_number,
+        "amount": amount,
+        "transaction_id": transaction_id
+    }
+    if hold_id:
+        params["hold_id"] = hold_id
+    try:
+        response = await call_bank(bank, "/debit", retry=True, params=params)
+        if response.status_code >= 500:
+            return {"success": False, "reason": f"{bank} returned {response.status_code}", "retryable": True}
+        return response.json()
+    except Exception as e:
+        # The debit may or may not have been applied
+        return {"success": False, "reason": str(e), "retryable": True}
+
+async def internal_transfer(bank: str, from_account: str, to_account: str, amount: float, token: str, transaction_id: str) -> dict:
+    """Move funds between two accounts of the same bank in one call"""
+    try:
+        response = await call_bank(
+            bank,
+            "/internal-transfer",
+            retry=True,
+            json={
+                "from_account": from_account,
+                "to_account": to_account,
+                "amount": amount,
+                "token": token,
+                "transaction_id": transaction_id
+            }
+        )
+        if response.status_code >= 500:
+            return {"success": False, "reason": f"{bank} returned {response.status_code}", "retryable": True}
+        return response.json()
+    except Exception as e:
+        return {"success": False, "reason": str(e), "retryable": True}
 
-async def credit_account(bank_url: str, account_number: str, amount: float, transaction_id: str) -> dict:
+async def credit_account(bank: str, account_number: str, amount: float, transaction_id: str) -> dict:
     """Credit amount to receiver's account"""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"{bank_url}/credit",
-                params={
-                    "account_number": account_number,
-                    "amount": amount,
-                    "transaction_id": transaction_id
-                },
-                timeout=10.0
+    try:
+        response = await call_bank(
+            bank,
+            "/credit",
+            retry=True,
+            params={
+                "account_number": account_number,
+                "amount": amount,
+                "transaction_id": transaction_id
+            }
+        )
+        if response.status_code >= 500:
+            return {"success": False, "reason": f"{bank} returned {response.status_code}", "retryable": True}
+        return response.json()
+    except Exception as e:
+        # The credit may or may not have been applied
+        return {"success": False, "reason": str(e), "retryable": True}
+
+async def bulk_bank_call(bank: str, path: str, field: str, items: List[dict], failure: dict, retry: bool = False) -> List[dict]:
+    """Send many items to one bulk bank endpoint; returns one result per item"""
+    try:
+        response = await call_bank(bank, path, retry=retry, json={field: items})
+        results = response.json()["results"]
+        if len(results) != len(items):
+            raise ValueError(f"{bank} returned {len(results)} results for {len(items)} items")
+        return results
+    except Exception as e:
+        # No item got a definite answer
+        return [dict(failure, reason=str(e), retryable=True) for _ in items]
+
+class Compensator:
+    """
+    Settles cross-bank transfers left half done, off the request path.
+    An authorized transfer is debited (the bank skips a debit it already
+    applied), a debited one is credited until the receiver's bank gives a
+    definite answer, and if that answer is a refusal the sender is
+    refunded. Every step is recorded in the WAL before the next one, and
+    failed calls are retried with exponential backoff. The outcome of a
+    keyed transfer is stored under its idempotency key, so a retry that
+    got "pending" before now gets the final result.
+    """
+
+    def __init__(self, wal: TransferWAL):
+        self.wal = wal
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.completed = 0
+        self.refunded = 0
+        self.aborted = 0
+
+    def submit(self, transaction_id: str):
+        if transaction_id in self._tasks:
+            return
+        task = asyncio.create_task(self._settle(transaction_id))
+        self._tasks[transaction_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(transaction_id, None))
+
+    def busy(self, transaction_id: str) -> bool:
+        return transaction_id in self._tasks
+
+    async def _retry(self, call):
+        """Repeat call() while it fails without a definite answer from the bank"""
+        delay = COMPENSATION_RETRY_DELAY
+        while True:
+            result = await call()
+            if result.get("success") or not result.get("retryable"):
+                return result
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, COMPENSATION_MAX_DELAY)
+
+    async def _settle(self, transaction_id: str):
+        # Not bound by the deadline of the request that handed the transfer over
+        request_deadline.set(None)
+        entry = self.wal.transfers[transaction_id]
+        request = TransferRequest(
+            from_account=entry["from_account"],
+            to_account=entry["to_account"],
+            amount=entry["amount"],
+            token="",
+            description=entry.get("description", ""),
+            idempotency_key=entry.get("idempotency_key")
+        )
+        sender_bank, receiver_bank = entry["sender_bank"], entry["receiver_bank"]
+        
+        if entry["state"] == "authorized":
+            debit_result = await self._retry(lambda: debit_account(
+                sender_bank, request.from_account, request.amount, transaction_id, hold_id=entry.get("hold_id")
+            ))
+            if not debit_result.get("success"):
+                if entry.get("hold_id"):
+                    await release_hold(sender_bank, entry["hold_id"])
+                self.wal.record(transaction_id, "aborted", reason=debit_result.get("reason"))
+                self.aborted += 1
+                print(f"↩️ Transfer {transaction_id} aborted: {debit_result.get('reason')}")
+                await self._remember(request, TransferResponse(
+                    success=False,
+                    message=f"Failed to debit sender account: {debit_result.get('reason', 'Unknown error')}"
+                ))
+                return
+            self.wal.record(transaction_id, "debited")
+        
+        if entry["state"] == "debited":
+            credit_result = await self._retry(lambda: credit_account(
+                receiver_bank, request.to_account, request.amount, transaction_id
+            ))
+            if credit_result.get("success"):
+                self.wal.record(transaction_id, "credited")
+                await log_transaction(request, transaction_id, sender_bank, receiver_bank)
+                self.completed += 1
+                print(f"✅ Transfer {transaction_id} completed by compensator")
+                await self._remember(request, TransferResponse(
+                    success=True,
+                    transaction_id=transaction_id,
+                    message="Transfer completed successfully",
+                    details={"receiver_new_balance": credit_result.get("new_balance")}
+                ))
+                return
+            # Durable before refunding, so recovery never retries the credit afterwards
+            await self.wal.record(transaction_id, "compensating", reason=credit_result.get("reason"))
+        
+        # compensating: keep trying the refund, the sender's bank has to take it eventually
+        refund_id = str(uuid.uuid5(REFUND_NAMESPACE, transaction_id))
+        delay = COMPENSATION_RETRY_DELAY
+        while not (await credit_account(sender_bank, request.from_account, request.amount, refund_id)).get("success"):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, COMPENSATION_MAX_DELAY)
+        self.wal.record(transaction_id, "compensated", refund_id=refund_id)
+        await log_transaction(request, transaction_id, sender_bank, receiver_bank, status="refunded")
+        self.refunded += 1
+        print(f"↩️ Transfer {transaction_id} refunded to {request.from_account}")
+        await self._remember(request, TransferResponse(
+            success=False,
+            transaction_id=transaction_id,
+            message=f"Transfer was refunded: {entry.get('reason', 'Unknown error')}"
+        ))
+
+    @staticmethod
+    async def _remember(request: TransferRequest, response: TransferResponse):
+        key = scoped_idempotency_key(request)
+        if key:
+            await idempotency_store.remember(key, transfer_fingerprint(request), response)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "settling": len(self._tasks),
+            "completed": self.completed,
+            "refunded": self.refunded,
+            "aborted": self.aborted
+        }
+
+compensator = Compensator(transfer_wal)
+
+class TransferQueue:
+    """
+    Async transfers: jobs wait in a bounded queue and a pool of worker
+    tasks executes them, holding one slot per bank involved so that no
+    bank has more than per_bank transfers in progress. Jobs stay
+    available for polling by transaction id; the oldest finished ones are
+    dropped beyond max_jobs. Queued jobs live in memory only and are lost
+    on restart, but none of them has touched a bank yet. With shared state
+    each status change is also published so other workers can answer polls.
+    """
+
+    def __init__(self, workers: int, per_bank: int, max_queued: int, max_jobs: int, state: Optional[SQLiteState] = None):
+        self.state = state
+        self.worker_count = workers
+        self.per_bank = per_bank
+        self.max_queued = max_queued
+        self.max_jobs = max_jobs
+        self.jobs: "OrderedDict[str, dict]" = OrderedDict()  # transaction_id -> job
+        self.busy = 0
+        self.bank_slots_in_use: Dict[str, int] = {}
+        self._bank_slots: Dict[str, asyncio.Semaphore] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        self._queue = asyncio.Queue(self.max_queued)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, request: TransferRequest, transaction_id: str, idempotency_key: Optional[str] = None) -> dict:
+        """Queue a transfer; raises asyncio.QueueFull when the queue is at capacity"""
+        job = {
+            "transaction_id": transaction_id,
+            "status": "queued",
+            "queued_at": datetime.utcnow().isoformat(),
+            "result": None,
+            "request": request,
+            "idempotency_key": idempotency_key,
+            "enqueued": time.perf_counter(),
+            "done": asyncio.Event()
+        }
+        self._queue.put_nowait(job)
+        self.jobs[transaction_id] = job
+        await self._publish(job)
+        while len(self.jobs) > self.max_jobs:
+            oldest = next(iter(self.jobs.values()))
+            if not oldest["done"].is_set():
+                break
+            self.jobs.popitem(last=False)
+        return job
+
+    @asynccontextmanager
+    async def _bank_slot(self, bank: str):
+        slots = self._bank_slots.get(bank)
+        if slots is None:
+            slots = self._bank_slots[bank] = asyncio.Semaphore(self.per_bank)
+        async with slots:
+            self.bank_slots_in_use[bank] = self.bank_slots_in_use.get(bank, 0) + 1
+            try:
+                yield
+            finally:
+                self.bank_slots_in_use[bank] -= 1
+
+    async def _execute(self, job: dict) -> TransferResponse:
+        request = job["request"]
+        banks = {identify_bank(request.from_account), identify_bank(request.to_account)} - {None}
+        async with AsyncExitStack() as stack:
+            # Always acquired in the same order, so two workers cannot wait on each other
+            for bank in sorted(banks):
+                await stack.enter_async_context(self._bank_slot(bank))
+            job["status"] = "processing"
+            await self._publish(job)
+            return await execute_transfer(request, job["transaction_id"])
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            TRANSFER_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - job["enqueued"])
+            self.busy += 1
+            key = job["idempotency_key"]
+            try:
+                result = await self._execute(job)
+            except Exception as e:
+                print(f"❌ Queued transfer {job['transaction_id']} failed: {e}")
+                if key:
+                    await idempotency_store.abandon(key, e)
+                result = TransferResponse(success=False, message=f"Transfer failed: {e}", transaction_id=job["transaction_id"])
+            else:
+                if key:
+                    await idempotency_store.complete(key, result)
+            finally:
+                self.busy -= 1
+            job["status"] = "completed" if result.success else "failed"
+            job["result"] = result
+            # The request carries the sender's token; don't keep it around
+            job["request"] = None
+            job["done"].set()
+            await self._publish(job)
+
+    def describe(self, job: dict) -> dict:
+        return {
+            "transaction_id": job["transaction_id"],
+            "status": job["status"],
+            "queued_at": job["queued_at"],
+            "result": job["result"]
+        }
+
+    async def _publish(self, job: dict):
+        if self.state is None:
+            return
+        # The job is already queued or running, so wait for the write lock rather than fail
+        await self.state.execute(
+            "INSERT INTO jobs (transaction_id, status, job) VALUES (?, ?, ?) "
+            "ON CONFLICT (transaction_id) DO UPDATE SET status = excluded.status, job = excluded.job",
+            (job["transaction_id"], job["status"], json.dumps(jsonable_encoder(self.describe(job)))),
+            record=True
+        )
+        if job["done"].is_set() and len(self.jobs) >= self.max_jobs:
+            # Keep about max_jobs rows; only finished jobs are dropped
+            await self.state.execute(
+                "DELETE FROM jobs WHERE status IN ('completed', 'failed') "
+                "AND seq <= (SELECT MAX(seq) FROM jobs) - ?",
+                (self.max_jobs,),
+                record=True
             )
-            return response.json()
-        except Exception as e:
-            return {"success": False, "reason": str(e)}
 
-@app.on_event("startup")
+    async def shared_status(self, transaction_id: str) -> Optional[dict]:
+        """Status of a job queued on any worker, None without shared state"""
+        if self.state is None:
+            return None
+        rows = await self.state.query("SELECT job FROM jobs WHERE transaction_id = ?", (transaction_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def wait_shared(self, transaction_id: str, timeout: float):
+        """Poll a job queued on another worker until it finishes or timeout passes"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status = await self.shared_status(transaction_id)
+            if status is None or status["status"] in ("completed", "failed"):
+                return
+            await asyncio.sleep(SHARED_STATE_POLL_INTERVAL)
+
+transfer_queue = TransferQueue(TRANSFER_WORKERS, TRANSFER_WORKERS_PER_BANK, TRANSFER_QUEUE_SIZE, TRANSFER_JOBS_MAX, shared_state)
+TRANSFER_QUEUE_WAIT_SECONDS = metrics.histogram(
+    "gateway_transfer_queue_wait_seconds",
+    "Time async transfers spend queued before a worker picks them up",
+    ()
+)
+metrics.gauge(
+    "gateway_transfer_queue_depth",
+    "Async transfers waiting for a worker",
+    (),
+    lambda: {(): transfer_queue.depth()}
+)
+metrics.gauge(
+    "gateway_transfer_workers",
+    "Async transfer workers, by state (busy includes waiting for a bank slot)",
+    ("state",),
+    lambda: {("busy",): transfer_queue.busy, ("idle",): transfer_queue.worker_count - transfer_queue.busy}
+)
+metrics.gauge(
+    "gateway_transfer_bank_slots_in_use",
+    "Async transfers in progress against each bank",
+    ("bank",),
+    lambda: {(bank,): count for bank, count in transfer_queue.bank_slots_in_use.items()}
+)
+
 async def startup():
     print("="*60)
     print("🌐 PAYMENT GATEWAY STARTING...")
-    print(f"🏦 Bank 1 URL: {BANK_SERVERS['BANK1']}")
-    print(f"🏦 Bank 2 URL: {BANK_SERVERS['BANK2']}")
+    await bank_clients.start()
+    print(f"🗺️ Routing table: {GATEWAY_ROUTES_PATH or 'built-in defaults'}")
+    for route in bank_clients.table.routes.values():
+        print(f"🏦 {route.name} ({', '.join(route.prefixes)}): {', '.join(route.endpoints)}")
     print(f"🔧 Testing bank connectivity...")
-    # Test connectivity
-    async with httpx.AsyncClient() as client:
-        for bank_name, bank_url in BANK_SERVERS.items():
-            try:
-                response = await client.get(f"{bank_url}/", timeout=5.0)
-                if response.status_code == 200:
-                    print(f"✅ {bank_name} is reachable")
-                else:
-                    print(f"⚠️ {bank_name} returned status {response.status_code}")
-            except Exception as e:
-                print(f"❌ {bank_name} is not reachable: {e}")
+    await health_monitor.check_all()
+    for bank_name, health in health_monitor.status.items():
+        if health["status"] == "connected":
+            print(f"✅ {bank_name} is reachable")
+        else:
+            print(f"❌ {bank_name} is {health['status']}")
+    health_monitor.start()
+    transfer_queue.start()
+    idempotency_store.start()
+    # Recovery: resume every transfer the previous run left unfinished
+    unfinished = transfer_wal.open()
+    for entry in unfinished:
+        if entry["state"] == "started":
+            # Nothing was debited; the sender's hold expires on its own
+            transfer_wal.record(entry["transaction_id"], "aborted", reason="Gateway restarted before authorization")
+        else:
+            compensator.submit(entry["transaction_id"])
+    print(f"📒 WAL {transfer_wal.path}: {len(unfinished)} unfinished transfer(s) to recover")
+    print(f"🗄️ Gateway state: {GATEWAY_STORAGE_PATH if shared_state is not None else 'in memory'}")
+    print(f"🔌 HTTP pool: max {BANK_HTTP_MAX_CONNECTIONS} connections, {BANK_HTTP_MAX_KEEPALIVE} keep-alive per bank")
     print("="*60)
 
+async def shutdown():
+    await transfer_queue.stop()
+    await health_monitor.stop()
+    await idempotency_store.stop()
+    # Unsettled transfers stay in the WAL and are resumed on the next start
+    await compensator.stop()
+    await transfer_wal.close()
+    await bank_clients.close()
+    transaction_log.close()
+    if shared_state is not None:
+        shared_state.close()
+    print("🛑 Payment gateway stopped, bank connections closed")
+
 # Routes
 @app.get("/")
 def read_root():
     return {
         "message": "Payment Gateway API",
         "status": "running",
-        "banks_connected": list(BANK_SERVERS.keys())
+        "banks_connected": bank_clients.banks()
     }
 
+def transfer_fingerprint(request: TransferRequest) -> str:
+    body = f"{request.from_account}|{request.to_account}|{request.amount}|{request.description}"
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def scoped_idempotency_key(request: TransferRequest) -> Optional[str]:
+    """Keys are scoped to the sending account"""
+    if request.idempotency_key:
+        return f"{request.from_account}:{request.idempotency_key}"
+    return None
+
+def transaction_id_for(request: TransferRequest) -> str:
+    if request.idempotency_key:
+        return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, scoped_idempotency_key(request)))
+    return str(uuid.uuid4())
+
+def client_address(http_request: Request) -> str:
+    return http_request.client.host if http_request.client else "unknown"
+
+def reject_admission(rejection: tuple):
+    reason, retry_after = rejection
+    if math.isinf(retry_after):
+        raise HTTPException(status_code=422, detail=f"Amount exceeds the account transfer limit of {VELOCITY_MAX_AMOUNT:g}")
+    raise HTTPException(
+        status_code=429,
+        detail=reason,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+async def admit_transfer(request: TransferRequest, http_request: Request):
+    """Rate and velocity limits, checked before any bank call; raises 429 with Retry-After"""
+    rejection = await admission.check_client(client_address(http_request))
+    rejection = rejection or await admission.check_account(request.from_account, request.amount)
+    if rejection:
+        reject_admission(rejection)
+
+def accepted_response(transaction_id: str) -> JSONResponse:
+    status_url = f"/transaction/{transaction_id}"
+    return JSONResponse(
+        status_code=202,
+        content={
+            "transaction_id": transaction_id,
+            "status": "queued",
+            "message": "Transfer accepted for processing",
+            "status_url": status_url
+        },
+        headers={"Location": status_url}
+    )
+
+async def enqueue_transfer(request: TransferRequest, transaction_id: str, key: Optional[str] = None) -> JSONResponse:
+    try:
+        await transfer_queue.submit(request, transaction_id, key)
+    except asyncio.QueueFull:
+        error = HTTPException(status_code=503, detail="Transfer queue is full", headers={"Retry-After": "1"})
+        if key:
+            await idempotency_store.abandon(key, error)
+        raise error
+    return accepted_response(transaction_id)
+
 @app.post("/transfer", response_model=TransferResponse)
-async def process_transfer(request: TransferRequest):
+async def process_transfer(
+    request: TransferRequest,
+    http_request: Request,
+    idempotency_key: Optional[str] = Header(None),
+    prefer: Optional[str] = Header(None)
+):
     """
     Process a transfer between accounts (can be same or different banks)
     
+    An idempotency key (the Idempotency-Key header or the idempotency_key
+    field) makes retries safe: a duplicate waits for the first execution
+    and receives its result instead of moving money again.
+    Requests over the rate or velocity limits get 429 with Retry-After;
+    replays of a stored result, and duplicates of a request still in
+    flight, are not counted.
+    With "Prefer: respond-async" (or ASYNC_TRANSFERS set) the transfer is
+    queued and the reply is 202 with the transaction id; poll
+    /transaction/{id}, optionally with ?wait=<seconds>, for the outcome.
+    """
+    if idempotency_key and not request.idempotency_key:
+        request.idempotency_key = idempotency_key
+    respond_async = ASYNC_TRANSFERS or "respond-async" in (prefer or "").lower()
+    transaction_id = transaction_id_for(request)
+    if not request.idempotency_key:
+        await admit_transfer(request, http_request)
+        if respond_async:
+            return await enqueue_transfer(request, transaction_id)
+        return await execute_transfer(request, transaction_id)
+    
+    key = scoped_idempotency_key(request)
+    fingerprint = transfer_fingerprint(request)
+    existing = await idempotency_store.lookup(key, fingerprint)
+    if existing is None:
+        # With shared state another worker may have claimed the key since the lookup
+        existing = await idempotency_store.begin(key, fingerprint)
+        if existing is None:
+            # Admitted only once claimed: concurrent duplicates wait for this
+            # request instead of each spending a rate token, and get its 429
+            try:
+                await admit_transfer(request, http_request)
+            except BaseException as e:
+                await idempotency_store.abandon(key, e)
+                raise
+    if isinstance(existing, asyncio.Future):
+        if respond_async:
+            return accepted_response(transaction_id)
+        return await asyncio.shield(existing)
+    if existing is not None:
+        return existing
+    
+    if respond_async:
+        return await enqueue_transfer(request, transaction_id, key)
+    try:
+        response = await execute_transfer(request, transaction_id)
+    except BaseException as e:
+        await idempotency_store.abandon(key, e)
+        raise
+    await idempotency_store.complete(key, response)
+    return response
+
+async def execute_transfer(request: TransferRequest, transaction_id: str) -> TransferResponse:
+    """
     Flow:
     1. Identify sender and receiver banks
-    2. Verify sender's account and token with sender's bank
-    3. Verify receiver's account with receiver's bank
-    4. Authorize transaction with sender's bank
-    5. Debit sender's account
-    6. Credit receiver's account
-    7. Log transaction
+       (same bank: the bank moves the funds atomically in one call, then log)
+    2. Concurrently:
+       - prepare with sender's bank (verify account, check token, hold funds)
+       - verify receiver's account with receiver's bank
+    3. Debit sender's account against the hold
+    4. Credit receiver's account
+    5. Log transaction
+    Each cross-bank step is recorded in the WAL; a transfer whose debit
+    or credit fails without a definite answer is handed to the
+    compensator, which completes it or refunds the sender.
     """
     
+    # One budget for every bank call below; the request runs in its own task,
+    # so the deadline does not outlive it
+    request_deadline.set(time.monotonic() + TRANSFER_SLO_SECONDS)
+    
     # Validate amount
     if request.amount <= 0:
         return TransferResponse(
@@ -165,7 +2442,6 @@ async def process_transfer(request: TransferRequest):
             message="Amount must be greater than zero"
         )
     
-    transaction_id = str(uuid.uuid4())
     print(f"Processing transfer: {request.from_account} -> {request.to_account}, Amount: ${request.amount}")
     
     # Step 1: Identify banks
@@ -184,70 +2460,198 @@ async def process_transfer(request: TransferRequest):
             message="Receiver bank not identified"
         )
     
-    sender_bank_url = BANK_SERVERS[sender_bank]
-    receiver_bank_url = BANK_SERVERS[receiver_bank]
+    for bank in (sender_bank, receiver_bank):
+        if not health_monitor.available(bank):
+            return unavailable_response(bank)
     
-    # Step 2: Verify sender account
-    sender_verification = await verify_account_with_bank(sender_bank_url, request.from_account)
-    if not sender_verification.get("exists"):
-        return TransferResponse(
-            success=False,
-            message="Sender account not found"
-        )
+    if sender_bank == receiver_bank:
+        return await process_internal_transfer(request, sender_bank, transaction_id)
     
-    # Step 3: Verify receiver account
-    receiver_verification = await verify_account_with_bank(receiver_bank_url, request.to_account)
-    if not receiver_verification.get("exists"):
-        return TransferResponse(
-            success=False,
-            message="Receiver account not found"
-        )
+    if transaction_id in transfer_wal.transfers:
+        # A retry of a keyed transfer the compensator is still settling
+        return settling_response(transaction_id)
     
-    # Step 4: Authorize with sender's bank
-    authorization = await authorize_with_sender_bank(
-        sender_bank_url,
-        request.from_account,
-        request.amount,
-        request.token
+    transfer_wal.record(
+        transaction_id,
+        "started",
+        from_account=request.from_account,
+        to_account=request.to_account,
+        amount=request.amount,
+        description=request.description,
+        sender_bank=sender_bank,
+        receiver_bank=receiver_bank,
+        idempotency_key=request.idempotency_key
+    )
+    
+    # Step 2: Prepare sender side and verify receiver side in parallel
+    stage_start = time.perf_counter()
+    preparation, receiver_verification = await asyncio.gather(
+        prepare_with_sender_bank(
+            sender_bank,
+            request.from_account,
+            request.amount,
+            request.token
+        ),
+        verify_account_with_bank(receiver_bank, request.to_account)
+    )
+    stage_start = observe_stage(
+        "prepare",
+        stage_start,
+        preparation.get("prepared") and receiver_verification.get("exists")
     )
     
-    if not authorization.get("authorized"):
+    if preparation.get("exists") is False:
+        transfer_wal.record(transaction_id, "aborted", reason="Sender account not found")
         return TransferResponse(
             success=False,
-            message=f"Transaction not authorized: {authorization.get('reason', 'Unknown error')}"
+            message="Sender account not found"
         )
     
-    # Step 5: Debit sender's account
+    if not preparation.get("prepared"):
+        transfer_wal.record(transaction_id, "aborted", reason=preparation.get("reason"))
+        return not_authorized_response(preparation)
+    
+    hold_id = preparation.get("hold_id")
+    
+    if not receiver_verification.get("exists"):
+        await release_hold(sender_bank, hold_id)
+        transfer_wal.record(transaction_id, "aborted", reason="Receiver account not found")
+        return receiver_not_found_response(receiver_verification)
+    
+    # Must be on disk before the debit: from here on recovery has to finish or refund
+    stage_start = time.perf_counter()
+    await transfer_wal.record(transaction_id, "authorized", hold_id=hold_id)
+    stage_start = observe_stage("wal_authorize", stage_start, True)
+    
+    # Step 3: Debit sender's account
     debit_result = await debit_account(
-        sender_bank_url,
+        sender_bank,
         request.from_account,
         request.amount,
-        transaction_id
+        transaction_id,
+        hold_id=hold_id
     )
+    stage_start = observe_stage("debit", stage_start, debit_result.get("success"))
     
     if not debit_result.get("success"):
+        if debit_result.get("retryable"):
+            compensator.submit(transaction_id)
+            return settling_response(transaction_id)
+        await release_hold(sender_bank, hold_id)
+        transfer_wal.record(transaction_id, "aborted", reason=debit_result.get("reason"))
         return TransferResponse(
             success=False,
             message=f"Failed to debit sender account: {debit_result.get('reason', 'Unknown error')}"
         )
     
-    # Step 6: Credit receiver's account
+    transfer_wal.record(transaction_id, "debited")
+    
+    # Step 4: Credit receiver's account
     credit_result = await credit_account(
-        receiver_bank_url,
+        receiver_bank,
         request.to_account,
         request.amount,
         transaction_id
     )
+    observe_stage("credit", stage_start, credit_result.get("success"))
     
     if not credit_result.get("success"):
-        # TODO: Implement rollback mechanism in production
-        return TransferResponse(
-            success=False,
-            message=f"Failed to credit receiver account: {credit_result.get('reason', 'Unknown error')}",
-            transaction_id=transaction_id
-        )
+        compensator.submit(transaction_id)
+        return credit_failed_response(transaction_id, credit_result)
+    
+    transfer_wal.record(transaction_id, "credited")
+    
+    # Step 5: Log transaction
+    await log_transaction(request, transaction_id, sender_bank, receiver_bank)
+    
+    return TransferResponse(
+        success=True,
+        transaction_id=transaction_id,
+        message="Transfer completed successfully",
+        details={
+            "sender_new_balance": debit_result.get("new_balance"),
+            "receiver_new_balance": credit_result.get("new_balance")
+        }
+    )
+
+def transient(response: TransferResponse) -> TransferResponse:
+    """
+    Mark an outcome a retry may change: a bank was unreachable or the
+    transfer is still being settled. A retry with the same key runs again.
+    """
+    response._transient = True
+    return response
+
+def unavailable_response(bank: str) -> TransferResponse:
+    return transient(TransferResponse(success=False, message=f"{bank} is currently unavailable, please try again later"))
+
+def settling_response(transaction_id: str) -> TransferResponse:
+    return transient(TransferResponse(
+        success=False,
+        message="Transfer outcome is pending; it will be completed or refunded",
+        transaction_id=transaction_id
+    ))
+
+def not_authorized_response(preparation: dict) -> TransferResponse:
+    response = TransferResponse(
+        success=False,
+        message=f"Transaction not authorized: {preparation.get('reason', 'Unknown error')}"
+    )
+    return transient(response) if preparation.get("retryable") else response
+
+def receiver_not_found_response(verification: dict) -> TransferResponse:
+    response = TransferResponse(success=False, message="Receiver account not found")
+    return transient(response) if verification.get("retryable") else response
+
+def credit_failed_response(transaction_id: str, credit_result: dict) -> TransferResponse:
+    return transient(TransferResponse(
+        success=False,
+        message=f"Failed to credit receiver account: {credit_result.get('reason', 'Unknown error')}; "
+                "the transfer will be completed or refunded",
+        transaction_id=transaction_id
+    ))
+
+async def process_internal_transfer(request: TransferRequest, bank: str, transaction_id: str) -> TransferResponse:
+    """Same-bank fast path: one round trip, no separate debit/credit to roll back"""
+    stage_start = time.perf_counter()
+    result = await internal_transfer(
+        bank,
+        request.from_account,
+        request.to_account,
+        request.amount,
+        request.token,
+        transaction_id
+    )
+    observe_stage("internal_transfer", stage_start, result.get("success"))
+    return await internal_transfer_response(request, bank, transaction_id, result)
+
+async def internal_transfer_response(request: TransferRequest, bank: str, transaction_id: str, result: dict) -> TransferResponse:
+    if not result.get("success"):
+        error = result.get("error")
+        if error == "sender_not_found":
+            message = "Sender account not found"
+        elif error == "receiver_not_found":
+            message = "Receiver account not found"
+        elif error == "unauthorized":
+            message = f"Transaction not authorized: {result.get('reason', 'Unknown error')}"
+        else:
+            message = f"Transfer failed: {result.get('reason', 'Unknown error')}"
+        response = TransferResponse(success=False, message=message)
+        return transient(response) if result.get("retryable") else response
+    
+    await log_transaction(request, transaction_id, bank, bank)
     
-    # Step 7: Log transaction
+    return TransferResponse(
+        success=True,
+        transaction_id=transaction_id,
+        message="Transfer completed successfully",
+        details={
+            "sender_new_balance": result.get("sender_new_balance"),
+            "receiver_new_balance": result.get("receiver_new_balance")
+        }
+    )
+
+async def log_transaction(request: TransferRequest, transaction_id: str, sender_bank: str, receiver_bank: str, status: str = "completed") -> dict:
     transaction_record = {
         "transaction_id": transaction_id,
         "from_account": request.from_account,
@@ -257,50 +2661,410 @@ async def process_transfer(request: TransferRequest):
         "receiver_bank": receiver_bank,
         "description": request.description,
         "timestamp": datetime.utcnow().isoformat(),
-        "status": "completed"
+        "status": status
     }
-    transaction_log.append(transaction_record)
+    return await transaction_log.append(transaction_record)
+
+@app.post("/transfers/batch", response_model=BatchTransferResponse)
+async def process_batch_transfer(batch: BatchTransferRequest, http_request: Request):
+    """
+    Process many transfers with a fixed number of bank round trips
     
-    return TransferResponse(
-        success=True,
-        transaction_id=transaction_id,
-        message="Transfer completed successfully",
-        details={
-            "sender_new_balance": debit_result.get("new_balance"),
-            "receiver_new_balance": credit_result.get("new_balance")
-        }
+    Items are grouped per bank and sent to the banks' bulk endpoints:
+    1. Concurrently: bulk internal-transfer for same-bank items, bulk
+       prepare per sender bank and bulk verify per receiver bank
+    2. Bulk debit per sender bank (and release holds of rejected items)
+    3. Bulk credit per receiver bank
+    Each item gets its own result, in request order. The batch counts as
+    one request against the client's rate limit, and as one request per
+    sender account, with its item count and total amount, against that
+    account's limits.
+    Items with an idempotency_key are deduplicated as on /transfer: a
+    stored result is replayed, a key in use elsewhere is waited for, and a
+    key reused for a different transfer fails that item.
+    """
+    transfers = batch.transfers
+    if len(transfers) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {MAX_BATCH_SIZE} transfers")
+    rejection = await admission.check_client(client_address(http_request))
+    if rejection:
+        reject_admission(rejection)
+    
+    print(f"Processing batch of {len(transfers)} transfers")
+    request_deadline.set(time.monotonic() + BATCH_SLO_SECONDS)
+    results: List[Optional[TransferResponse]] = [None] * len(transfers)
+    claimed: Dict[int, str] = {}  # index -> key this batch executes
+    waiting: Dict[int, asyncio.Future] = {}  # index -> first execution of its key
+    for i, transfer in enumerate(transfers):
+        key = scoped_idempotency_key(transfer)
+        if not key:
+            continue
+        fingerprint = transfer_fingerprint(transfer)
+        try:
+            existing = await idempotency_store.lookup(key, fingerprint)
+            if existing is None:
+                existing = await idempotency_store.begin(key, fingerprint)
+        except HTTPException as e:
+            results[i] = TransferResponse(success=False, message=e.detail)
+            continue
+        if isinstance(existing, asyncio.Future):
+            waiting[i] = existing
+        elif existing is not None:
+            results[i] = existing
+        else:
+            claimed[i] = key
+    
+    pending = [i for i, result in enumerate(results) if result is None and i not in waiting]
+    try:
+        await execute_batch(transfers, pending, results)
+    except BaseException as e:
+        for key in claimed.values():
+            await idempotency_store.abandon(key, e)
+        raise
+    for i, key in claimed.items():
+        await idempotency_store.complete(key, results[i])
+    # Only awaited now: a key repeated within this batch resolves in the loop above
+    for i, first_execution in waiting.items():
+        try:
+            results[i] = await asyncio.shield(first_execution)
+        except Exception as e:
+            results[i] = TransferResponse(success=False, message=getattr(e, "detail", None) or f"Transfer failed: {e}")
+    
+    succeeded = sum(1 for r in results if r.success)
+    return BatchTransferResponse(
+        total=len(results),
+        succeeded=succeeded,
+        failed=len(results) - succeeded,
+        results=results
     )
 
+async def execute_batch(transfers: List[TransferRequest], indexes: List[int], results: List[Optional[TransferResponse]]):
+    """Run the items at indexes through the bulk bank calls, filling in their results"""
+    # Keyed items get the same derived ids as /transfer, so the banks skip
+    # debits/credits already applied by an earlier attempt
+    transaction_ids = [transaction_id_for(t) for t in transfers]
+    banks = {}
+    internal_groups: Dict[str, List[int]] = {}
+    sender_groups: Dict[str, List[int]] = {}
+    receiver_groups: Dict[str, List[int]] = {}
+    senders: Dict[str, List[int]] = {}  # sender account -> its items, charged together
+    
+    for i in indexes:
+        transfer = transfers[i]
+        if transfer.amount <= 0:
+            results[i] = TransferResponse(success=False, message="Amount must be greater than zero")
+            continue
+        sender_bank = identify_bank(transfer.from_account)
+        receiver_bank = identify_bank(transfer.to_account)
+        if not sender_bank:
+            results[i] = TransferResponse(success=False, message="Sender bank not identified")
+            continue
+        if not receiver_bank:
+            results[i] = TransferResponse(success=False, message="Receiver bank not identified")
+            continue
+        unavailable = next((b for b in (sender_bank, receiver_bank) if not health_monitor.available(b)), None)
+        if unavailable:
+            results[i] = unavailable_response(unavailable)
+            continue
+        banks[i] = (sender_bank, receiver_bank)
+        senders.setdefault(transfer.from_account, []).append(i)
+    
+    for account, sent in senders.items():
+        rejection = await admission.check_account(account, sum(transfers[i].amount for i in sent), len(sent))
+        if rejection:
+            reason, retry_after = rejection
+            if math.isinf(retry_after):
+                message = f"Amount exceeds the account transfer limit of {VELOCITY_MAX_AMOUNT:g}"
+            else:
+                message = f"{reason}, retry after {max(1, math.ceil(retry_after))}s"
+            for i in sent:
+                # Not stored under the key, as /transfer rejects these before claiming it
+                results[i] = transient(TransferResponse(success=False, message=message))
+            continue
+        for i in sent:
+            sender_bank, receiver_bank = banks[i]
+            if sender_bank == receiver_bank:
+                internal_groups.setdefault(sender_bank, []).append(i)
+            elif transaction_ids[i] in transfer_wal.transfers:
+                results[i] = settling_response(transaction_ids[i])
+            else:
+                sender_groups.setdefault(sender_bank, []).append(i)
+                receiver_groups.setdefault(receiver_bank, []).append(i)
+    
+    preparations: Dict[int, dict] = {}
+    receiver_verifications: Dict[int, dict] = {}
+    
+    async def run_internal(bank: str, indexes: List[int]):
+        items = [{
+            "from_account": transfers[i].from_account,
+            "to_account": transfers[i].to_account,
+            "amount": transfers[i].amount,
+            "token": transfers[i].token,
+            "transaction_id": transaction_ids[i]
+        } for i in indexes]
+        bank_results = await bulk_bank_call(bank, "/bulk/internal-transfer", "transfers", items, {"success": False}, retry=True)
+        for i, result in zip(indexes, bank_results):
+            results[i] = await internal_transfer_response(transfers[i], bank, transaction_ids[i], result)
+    
+    async def run_prepare(bank: str, indexes: List[int]):
+        items = [{
+            "from_account": transfers[i].from_account,
+            "amount": transfers[i].amount,
+            "token": transfers[i].token
+        } for i in indexes]
+        bank_results = await bulk_bank_call(bank, "/bulk/prepare-transfer", "transfers", items, {"prepared": False, "exists": None})
+        preparations.update(zip(indexes, bank_results))
+    
+    async def run_verify(bank: str, indexes: List[int]):
+        items = [transfers[i].to_account for i in indexes]
+        bank_results = await bulk_bank_call(bank, "/bulk/verify-account", "account_numbers", items, {"exists": False}, retry=True)
+        receiver_verifications.update(zip(indexes, bank_results))
+    
+    # Round 1: same-bank transfers, sender preparation and receiver verification
+    await asyncio.gather(
+        *(run_internal(bank, indexes) for bank, indexes in internal_groups.items()),
+        *(run_prepare(bank, indexes) for bank, indexes in sender_groups.items()),
+        *(run_verify(bank, indexes) for bank, indexes in receiver_groups.items())
+    )
+    
+    releases: Dict[str, List[str]] = {}
+    debits: Dict[str, List[int]] = {}
+    for indexes in sender_groups.values():
+        for i in indexes:
+            preparation = preparations[i]
+            sender_bank = banks[i][0]
+            if preparation.get("exists") is False:
+                results[i] = TransferResponse(success=False, message="Sender account not found")
+            elif not preparation.get("prepared"):
+                results[i] = not_authorized_response(preparation)
+            elif not receiver_verifications[i].get("exists"):
+                releases.setdefault(sender_bank, []).append(preparation["hold_id"])
+                results[i] = receiver_not_found_response(receiver_verifications[i])
+            else:
+                debits.setdefault(sender_bank, []).append(i)
+    
+    # On disk before any debit, as for single transfers
+    await asyncio.gather(*(
+        transfer_wal.record(
+            transaction_ids[i],
+            "authorized",
+            from_account=transfers[i].from_account,
+            to_account=transfers[i].to_account,
+            amount=transfers[i].amount,
+            description=transfers[i].description,
+            sender_bank=banks[i][0],
+            receiver_bank=banks[i][1],
+            idempotency_key=transfers[i].idempotency_key,
+            hold_id=preparations[i]["hold_id"]
+        )
+        for indexes in debits.values() for i in indexes
+    ))
+    
+    debit_results: Dict[int, dict] = {}
+    
+    async def run_debit(bank: str, indexes: List[int]):
+        items = [{
+            "account_number": transfers[i].from_account,
+            "amount": transfers[i].amount,
+            "transaction_id": transaction_ids[i],
+            "hold_id": preparations[i]["hold_id"]
+        } for i in indexes]
+        bank_results = await bulk_bank_call(bank, "/bulk/debit", "entries", items, {"success": False}, retry=True)
+        debit_results.update(zip(indexes, bank_results))
+    
+    async def run_release(bank: str, hold_ids: List[str]):
+        await bulk_bank_call(bank, "/bulk/release-hold", "hold_ids", hold_ids, {"success": False})
+    
+    # Round 2: debit senders, release holds of items that will not proceed
+    await asyncio.gather(
+        *(run_debit(bank, indexes) for bank, indexes in debits.items()),
+        *(run_release(bank, hold_ids) for bank, hold_ids in releases.items())
+    )
+    
+    releases = {}
+    credits: Dict[str, List[int]] = {}
+    for i, debit_result in debit_results.items():
+        sender_bank, receiver_bank = banks[i]
+        if debit_result.get("success"):
+            transfer_wal.record(transaction_ids[i], "debited")
+            credits.setdefault(receiver_bank, []).append(i)
+        elif debit_result.get("retryable"):
+            compensator.submit(transaction_ids[i])
+            results[i] = settling_response(transaction_ids[i])
+        else:
+            releases.setdefault(sender_bank, []).append(preparations[i]["hold_id"])
+            transfer_wal.record(transaction_ids[i], "aborted", reason=debit_result.get("reason"))
+            results[i] = TransferResponse(
+                success=False,
+                message=f"Failed to debit sender account: {debit_result.get('reason', 'Unknown error')}"
+            )
+    
+    credit_results: Dict[int, dict] = {}
+    
+    async def run_credit(bank: str, indexes: List[int]):
+        items = [{
+            "account_number": transfers[i].to_account,
+            "amount": transfers[i].amount,
+            "transaction_id": transaction_ids[i]
+        } for i in indexes]
+        bank_results = await bulk_bank_call(bank, "/bulk/credit", "entries", items, {"success": False}, retry=True)
+        credit_results.update(zip(indexes, bank_results))
+    
+    # Round 3: credit receivers
+    await asyncio.gather(
+        *(run_credit(bank, indexes) for bank, indexes in credits.items()),
+        *(run_release(bank, hold_ids) for bank, hold_ids in releases.items())
+    )
+    
+    for i, credit_result in credit_results.items():
+        sender_bank, receiver_bank = banks[i]
+        if not credit_result.get("success"):
+            compensator.submit(transaction_ids[i])
+            results[i] = credit_failed_response(transaction_ids[i], credit_result)
+            continue
+        transfer_wal.record(transaction_ids[i], "credited")
+        await log_transaction(transfers[i], transaction_ids[i], sender_bank, receiver_bank)
+        results[i] = TransferResponse(
+            success=True,
+            transaction_id=transaction_ids[i],
+            message="Transfer completed successfully",
+            details={
+                "sender_new_balance": debit_results[i].get("new_balance"),
+                "receiver_new_balance": credit_result.get("new_balance")
+            }
+        )
+
 @app.get("/transaction/{transaction_id}")
-def get_transaction(transaction_id: str):
-    """Get transaction details by ID"""
-    for transaction in transaction_log:
-        if transaction["transaction_id"] == transaction_id:
-            return transaction
+async def get_transaction(transaction_id: str, wait: float = 0):
+    """
+    Get transaction details by ID
+    
+    For an async transfer that has not completed, returns its job status
+    (queued, processing or failed) and result; wait=<seconds> holds the
+    request until the transfer finishes (at most 30 s).
+    """
+    job = transfer_queue.jobs.get(transaction_id)
+    if job is not None and wait > 0:
+        try:
+            await asyncio.wait_for(job["done"].wait(), timeout=min(wait, MAX_POLL_WAIT_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+    elif wait > 0:
+        # Possibly queued on another worker
+        await transfer_queue.wait_shared(transaction_id, min(wait, MAX_POLL_WAIT_SECONDS))
     
+    transaction = await transaction_log.get(transaction_id)
+    if transaction is not None:
+        return transaction
+    if job is not None:
+        return transfer_queue.describe(job)
+    status = await transfer_queue.shared_status(transaction_id)
+    if status is not None:
+        return status
     raise HTTPException(status_code=404, detail="Transaction not found")
 
 @app.get("/transactions")
-def get_all_transactions():
-    """Get all transactions (for demo purposes)"""
-    return {"transactions": transaction_log}
+async def get_all_transactions(
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    account: Optional[str] = None,
+    bank: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """
+    List transactions, newest first
+    
+    Filter by account (sender or receiver), bank (sender or receiver bank)
+    and a UTC since/until range; pass next_cursor back as cursor for the
+    next page.
+    """
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    
+    position = None
+    if cursor is not None:
+        try:
+            position = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    # Stored timestamps are naive UTC
+    if since and since.tzinfo:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    if until and until.tzinfo:
+        until = until.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    transactions, next_position = await transaction_log.query(limit, position, account, bank, since, until)
+    return {
+        "transactions": transactions,
+        "next_cursor": str(next_position) if next_position is not None else None,
+        "total": await transaction_log.count()
+    }
+
+@app.get("/routes")
+def get_routes():
+    """Current routing table"""
+    return {
+        "source": GATEWAY_ROUTES_PATH or "defaults",
+        "reloads": bank_clients.reloads,
+        "banks": {
+            route.name: {"prefixes": route.prefixes, "endpoints": route.endpoints, "healthy": route.healthy}
+            for route in bank_clients.table.routes.values()
+        }
+    }
+
+@app.post("/routes/reload")
+async def reload_routes():
+    """Re-read the routing table now instead of waiting for the file watcher"""
+    try:
+        bank_clients.load()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Routing table not reloaded: {e}")
+    return {"reloaded": True, "banks": bank_clients.banks()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Latency histograms in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/wal/stats")
+def get_wal_stats():
+    """Write-ahead log counters and transfers still being settled"""
+    return {**transfer_wal.stats(), "compensator": compensator.stats()}
+
+@app.get("/queue/stats")
+def get_queue_stats():
+    """Async transfer queue and worker pool counters"""
+    return {
+        "depth": transfer_queue.depth(),
+        "capacity": TRANSFER_QUEUE_SIZE,
+        "workers": transfer_queue.worker_count,
+        "busy_workers": transfer_queue.busy,
+        "bank_slots_in_use": transfer_queue.bank_slots_in_use,
+        "tracked_jobs": len(transfer_queue.jobs)
+    }
+
+@app.get("/admission/stats")
+async def get_admission_stats():
+    """Rate and velocity limit counters"""
+    return await admission.stats()
+
+@app.get("/idempotency/stats")
+async def get_idempotency_stats():
+    """Idempotency result store counters"""
+    return await idempotency_store.stats()
 
 @app.get("/health")
 async def health_check():
-    """Check health of payment gateway and connected banks"""
-    bank_status = {}
-    
-    for bank_name, bank_url in BANK_SERVERS.items():
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(f"{bank_url}/", timeout=5.0)
-                bank_status[bank_name] = "connected" if response.status_code == 200 else "error"
-            except:
-                bank_status[bank_name] = "disconnected"
-    
+    """Health of the payment gateway and the banks, as of the last background probe"""
     return {
         "gateway": "healthy",
-        "banks": bank_status
+        "banks": {bank_name: health["status"] for bank_name, health in health_monitor.status.items()},
+        "details": {
+            bank_name: {**health, "circuit": circuit_breakers[bank_name].stats()}
+            for bank_name, health in health_monitor.status.items()
+        }
     }
 
 if __name__ == "__main__":
@@ -1,9 +1,22 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+import math
+import os
+import re
+import threading
+import time
 import uuid
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 app = FastAPI(title="Shopping App API", version="1.0")
 
 # CORS
@@ -13,8 +26,100 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", "X-Next-Cursor"],
+)
+
+# Metrics: Prometheus-style latency histograms, exposed on /metrics.
+# Observations are only made on the event loop, so they need no locking.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per tuple of label values"""
+
+    def __init__(self, name: str, description: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, seconds: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for labels, series in list(self._series.items()):
+            label_text = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, labels))
+            bucket_prefix = label_text + "," if label_text else ""
+            total = 0
+            for bound, count in zip(bounds, series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{bucket_prefix}le="{bound}"}} {total}')
+            series_labels = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{series_labels} {series[-1]}")
+            lines.append(f"{self.name}_count{series_labels} {total}")
+        return lines
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Histogram] = []
+
+    def histogram(self, name: str, description: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, description, labelnames, buckets)
+        self._metrics.append(histogram)
+        return histogram
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request",
+    ("method", "route", "status")
 )
 
+class RequestMetricsMiddleware:
+    """Plain ASGI middleware (cheaper than @app.middleware) timing every request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template, not the raw path, keeps path parameters out of the labels
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status_code)
+            )
+
+app.add_middleware(RequestMetricsMiddleware)
+
 @app.on_event("startup")
 async def startup_event():
     print("="*50)
@@ -31,6 +136,441 @@ async def startup_event():
 # In-memory product database
 products_db = []
 
+# Columnar filtering (needs numpy): brand, category, price and stock filters
+# run as vectorized masks over column arrays instead of the per-product indexes
+CATALOG_COLUMNAR = os.getenv("CATALOG_COLUMNAR", "false").lower() in ("1", "true", "yes")
+if CATALOG_COLUMNAR and np is None:
+    raise RuntimeError("CATALOG_COLUMNAR needs numpy; pip install -r requirements-columnar.txt")
+
+# Search: product text is split into lowercase alphanumeric tokens; a match
+# in the name counts for more than one in the brand, category or description
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+FIELD_WEIGHTS = {"name": 3.0, "brand": 2.0, "category": 2.0, "description": 1.0}
+# A query token that is only a prefix of the product's token scores this much of an exact match
+PREFIX_MATCH_WEIGHT = 0.5
+# A query token of at least INFIX_MIN_LENGTH characters also matches tokens
+# containing it ("phone" in "smartphone"), scoring this much of an exact match
+INFIX_MATCH_WEIGHT = 0.25
+INFIX_MIN_LENGTH = 3
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.casefold())
+
+class SearchIndex:
+    """
+    Inverted index over product text: each token maps to the products
+    containing it, with the summed weight of the fields it appears in.
+    A sorted vocabulary answers prefix lookups by bisect, and the
+    vocabulary's trigrams narrow down the tokens a query token can occur
+    inside, so a query only touches the postings of the tokens it matches.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[str, float]] = {}  # token -> {product_id: weight}
+        self._vocabulary: List[str] = []  # sorted tokens
+        self._trigrams: Dict[str, set] = {}  # trigram -> vocabulary tokens containing it
+        self._product_tokens: Dict[str, set] = {}  # product_id -> its tokens, for removal
+
+    def add(self, product: dict):
+        weights: Dict[str, float] = {}
+        for field, field_weight in FIELD_WEIGHTS.items():
+            for token in set(tokenize(product[field])):
+                weights[token] = weights.get(token, 0.0) + field_weight
+        for token, weight in weights.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                insort(self._vocabulary, token)
+                for trigram in self._trigrams_of(token):
+                    self._trigrams.setdefault(trigram, set()).add(token)
+            postings[product["product_id"]] = weight
+        self._product_tokens[product["product_id"]] = set(weights)
+
+    def remove(self, product_id: str):
+        for token in self._product_tokens.pop(product_id, ()):
+            postings = self._postings[token]
+            del postings[product_id]
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect_left(self._vocabulary, token)]
+                for trigram in self._trigrams_of(token):
+                    tokens = self._trigrams[trigram]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._trigrams[trigram]
+
+    @staticmethod
+    def _trigrams_of(token: str) -> set:
+        return {token[i:i + 3] for i in range(len(token) - 2)}
+
+    def _expand(self, prefix: str) -> List[str]:
+        """Vocabulary tokens starting with prefix"""
+        start = bisect_left(self._vocabulary, prefix)
+        end = start
+        while end < len(self._vocabulary) and self._vocabulary[end].startswith(prefix):
+            end += 1
+        return self._vocabulary[start:end]
+
+    def _containing(self, part: str) -> List[str]:
+        """Vocabulary tokens containing part other than at the start"""
+        if len(part) < INFIX_MIN_LENGTH:
+            return []
+        candidates = [self._trigrams.get(trigram) for trigram in self._trigrams_of(part)]
+        if not all(candidates):
+            return []
+        # Every token containing part has all of its trigrams; check the survivors
+        candidates.sort(key=len)
+        tokens = set.intersection(*candidates)
+        return [token for token in tokens if part in token and not token.startswith(part)]
+
+    def search(self, query: str) -> Optional[List[str]]:
+        """
+        Ids of the products matching every query token (as a whole token,
+        a prefix or, from INFIX_MIN_LENGTH characters, anywhere inside a
+        token), best first; None if the query has no tokens
+        """
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return None
+        product_count = len(self._product_tokens)
+        matches = []
+        for query_token in set(query_tokens):
+            scores: Dict[str, float] = {}
+            for token in self._expand(query_token) + self._containing(query_token):
+                postings = self._postings[token]
+                # Rare tokens say more about a product than ones most products share
+                weight = math.log(1 + product_count / len(postings))
+                if token != query_token:
+                    weight *= PREFIX_MATCH_WEIGHT if token.startswith(query_token) else INFIX_MATCH_WEIGHT
+                for product_id, field_weight in postings.items():
+                    scores[product_id] = max(scores.get(product_id, 0.0), field_weight * weight)
+            if not scores:
+                return []
+            matches.append(scores)
+        
+        # Intersect starting from the smallest candidate set
+        matches.sort(key=len)
+        ranked = matches[0]
+        for scores in matches[1:]:
+            ranked = {product_id: score + scores[product_id] for product_id, score in ranked.items() if product_id in scores}
+        return sorted(ranked, key=lambda product_id: -ranked[product_id])
+
+    def __len__(self):
+        return len(self._product_tokens)
+
+search_index = SearchIndex()
+
+# Sortable fields; the name sorts case-insensitively
+SORT_KEYS = {
+    "price": lambda p: p["price"],
+    "name": lambda p: p["name"].casefold(),
+    "stock": lambda p: p["stock"]
+}
+
+class SortedIndex:
+    """Product ids ordered by one field, with the keys alongside for bisect; ties keep insertion order"""
+
+    def __init__(self, key):
+        self.key = key
+        self.keys: list = []
+        self.ids: List[str] = []
+
+    def add(self, product: dict):
+        value = self.key(product)
+        i = bisect_right(self.keys, value)
+        self.keys.insert(i, value)
+        self.ids.insert(i, product["product_id"])
+
+    def extend(self, products: List[dict]):
+        """Add many products with one sort instead of an insert for each"""
+        entries = sorted(
+            zip(self.keys + [self.key(p) for p in products], self.ids + [p["product_id"] for p in products]),
+            key=lambda entry: entry[0]
+        )
+        self.keys = [value for value, _ in entries]
+        self.ids = [product_id for _, product_id in entries]
+
+    def remove(self, product: dict):
+        i = bisect_left(self.keys, self.key(product))
+        while self.ids[i] != product["product_id"]:
+            i += 1
+        del self.keys[i]
+        del self.ids[i]
+
+    def range(self, low, high) -> tuple:
+        """(start, end) of the entries with low <= key <= high"""
+        return bisect_left(self.keys, low), bisect_right(self.keys, high)
+
+class CatalogIndex:
+    """
+    Lookup structures over products_db: a hash index on product id,
+    case-folded hash indexes on brand and category, and sorted indexes on
+    price (also used for range queries by bisect), name and stock. Brand
+    and category buckets are dicts keyed by product id, so they keep
+    catalog order and answer membership in O(1).
+    """
+
+    def __init__(self):
+        self.by_id: Dict[str, dict] = {}
+        self.by_brand: Dict[str, Dict[str, dict]] = {}
+        self.by_category: Dict[str, Dict[str, dict]] = {}
+        self.sorted = {field: SortedIndex(key) for field, key in SORT_KEYS.items()}
+        self._positions: Dict[str, int] = {}  # product_id -> insertion order
+        self._next_position = 0
+
+    def _add_to_hash_indexes(self, product: dict):
+        product_id = product["product_id"]
+        self.by_id[product_id] = product
+        self._positions[product_id] = self._next_position
+        self._next_position += 1
+        self.by_brand.setdefault(product["brand"].casefold(), {})[product_id] = product
+        self.by_category.setdefault(product["category"].casefold(), {})[product_id] = product
+
+    def add(self, product: dict):
+        self._add_to_hash_indexes(product)
+        for index in self.sorted.values():
+            index.add(product)
+
+    def extend(self, products: List[dict]):
+        """Add many products, sorting each sorted index once instead of inserting into it for each"""
+        for product in products:
+            self._add_to_hash_indexes(product)
+        for index in self.sorted.values():
+            index.extend(products)
+
+    def remove(self, product_id: str) -> Optional[dict]:
+        product = self.by_id.pop(product_id, None)
+        if product is None:
+            return None
+        del self._positions[product_id]
+        for index, key in ((self.by_brand, product["brand"].casefold()), (self.by_category, product["category"].casefold())):
+            bucket = index[key]
+            del bucket[product_id]
+            if not bucket:
+                del index[key]
+        for index in self.sorted.values():
+            index.remove(product)
+        return product
+
+    def get(self, product_id: str) -> Optional[dict]:
+        return self.by_id.get(product_id)
+
+    def select(self, ranked_ids: Optional[List[str]] = None, brand: Optional[str] = None, category: Optional[str] = None,
+               min_price: Optional[float] = None, max_price: Optional[float] = None,
+               min_stock: Optional[int] = None) -> List[dict]:
+        """
+        Products passing every given filter, in rank order if ranked_ids
+        (text matches, best first) is given, else in catalog order. The
+        cheapest candidate set is walked and narrowed by the other filters.
+        """
+        brand_bucket = self.by_brand.get(brand.casefold(), {}) if brand else None
+        category_bucket = self.by_category.get(category.casefold(), {}) if category else None
+        has_price = min_price is not None or max_price is not None
+        low = -math.inf if min_price is None else min_price
+        high = math.inf if max_price is None else max_price
+        
+        # The cost of a source is its size, except for the price range, whose
+        # matches must be sorted back into catalog order
+        costs = {"all": len(self.by_id)}
+        if ranked_ids is not None:
+            costs["text"] = len(ranked_ids)
+        if brand_bucket is not None:
+            costs["brand"] = len(brand_bucket)
+        if category_bucket is not None:
+            costs["category"] = len(category_bucket)
+        if has_price:
+            start, end = self.sorted["price"].range(low, high)
+            count = max(0, end - start)
+            costs["price"] = count * math.log2(count + 1)
+        driver = min(costs, key=costs.get)
+        
+        if driver == "text":
+            products = [self.by_id[product_id] for product_id in ranked_ids]
+        elif driver == "brand":
+            products = list(brand_bucket.values())
+        elif driver == "category":
+            products = list(category_bucket.values())
+        elif driver == "price":
+            products = [self.by_id[product_id] for product_id in self.sorted["price"].ids[start:end]]
+            products.sort(key=lambda p: self._positions[p["product_id"]])
+        else:
+            products = list(self.by_id.values())
+        
+        if brand_bucket is not None and driver != "brand":
+            products = [p for p in products if p["product_id"] in brand_bucket]
+        if category_bucket is not None and driver != "category":
+            products = [p for p in products if p["product_id"] in category_bucket]
+        if has_price and driver != "price":
+            products = [p for p in products if low <= p["price"] <= high]
+        if min_stock is not None:
+            products = [p for p in products if p["stock"] >= min_stock]
+        if ranked_ids is not None and driver != "text":
+            rank = {product_id: i for i, product_id in enumerate(ranked_ids)}
+            products = [p for p in products if p["product_id"] in rank]
+            products.sort(key=lambda p: rank[p["product_id"]])
+        return products
+
+    def order(self, products: List[dict], field: str, descending: bool = False) -> List[dict]:
+        """
+        products sorted by field. A small set is sorted directly; a large
+        one is read in order off the field's sorted index.
+        """
+        if len(products) * math.log2(len(products) + 1) < len(self.by_id):
+            ordered = sorted(products, key=SORT_KEYS[field])
+        else:
+            wanted = {p["product_id"] for p in products} if len(products) < len(self.by_id) else self.by_id
+            ordered = [self.by_id[product_id] for product_id in self.sorted[field].ids if product_id in wanted]
+        if descending:
+            ordered.reverse()
+        return ordered
+
+    def __len__(self):
+        return len(self.by_id)
+
+catalog = CatalogIndex()
+
+class ColumnarCatalog:
+    """
+    Column-oriented copy of the catalog's filterable fields: price and
+    stock as NumPy arrays, brand and category as integer codes into
+    case-folded dictionaries. A search is one boolean mask per filter, and
+    only the matching rows are turned back into products. Arrays grow by
+    doubling; removed rows are masked out rather than deleted.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.price = np.zeros(capacity, dtype=np.float64)
+        self.stock = np.zeros(capacity, dtype=np.int64)
+        self.brand = np.zeros(capacity, dtype=np.int32)
+        self.category = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.brand_codes: Dict[str, int] = {}
+        self.category_codes: Dict[str, int] = {}
+        self._products: List[Optional[dict]] = []  # row -> product
+        self._rows: Dict[str, int] = {}  # product_id -> row
+
+    def _reserve(self, count: int):
+        capacity = len(self.price)
+        if self.size + count <= capacity:
+            return
+        capacity = max(self.size + count, capacity * 2)
+        for column in ("price", "stock", "brand", "category", "alive"):
+            old = getattr(self, column)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    @staticmethod
+    def _encode(codes: Dict[str, int], value: str) -> int:
+        return codes.setdefault(value.casefold(), len(codes))
+
+    def extend(self, products: List[dict]):
+        self._reserve(len(products))
+        start, end = self.size, self.size + len(products)
+        self.price[start:end] = [p["price"] for p in products]
+        self.stock[start:end] = [p["stock"] for p in products]
+        self.brand[start:end] = [self._encode(self.brand_codes, p["brand"]) for p in products]
+        self.category[start:end] = [self._encode(self.category_codes, p["category"]) for p in products]
+        self.alive[start:end] = True
+        for row, product in enumerate(products, start):
+            self._rows[product["product_id"]] = row
+        self._products.extend(products)
+        self.size = end
+
+    def add(self, product: dict):
+        self.extend([product])
+
+    def remove(self, product_id: str):
+        row = self._rows.pop(product_id, None)
+        if row is not None:
+            self.alive[row] = False
+            self._products[row] = None
+
+    def select(self, ranked_ids: Optional[List[str]] = None, brand: Optional[str] = None, category: Optional[str] = None,
+               min_price: Optional[float] = None, max_price: Optional[float] = None,
+               min_stock: Optional[int] = None) -> List[dict]:
+        """Same contract as CatalogIndex.select"""
+        mask = self.alive[:self.size].copy()
+        for codes, column, value in ((self.brand_codes, self.brand, brand), (self.category_codes, self.category, category)):
+            if value:
+                code = codes.get(value.casefold())
+                if code is None:
+                    return []
+                mask &= column[:self.size] == code
+        if min_price is not None:
+            mask &= self.price[:self.size] >= min_price
+        if max_price is not None:
+            mask &= self.price[:self.size] <= max_price
+        if min_stock is not None:
+            mask &= self.stock[:self.size] >= min_stock
+        
+        if ranked_ids is not None:
+            rows = np.fromiter((self._rows[product_id] for product_id in ranked_ids), dtype=np.int64, count=len(ranked_ids))
+            rows = rows[mask[rows]]
+        else:
+            rows = np.flatnonzero(mask)
+        return [self._products[row] for row in rows.tolist()]
+
+columnar = ColumnarCatalog() if CATALOG_COLUMNAR else None
+
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+
+class SearchCache:
+    """
+    LRU cache of search results keyed by the normalized search. Entries
+    remember the catalog version they were computed at; every catalog
+    change bumps the version, so older entries become misses. Searches
+    run in the threadpool, hence the lock.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.version = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (version, results)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def get(self, key: tuple) -> Optional[List[dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self.version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, version: int, results: List[dict]):
+        """Store results computed at version, unless the catalog has changed since"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (version, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "catalog_version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+search_cache = SearchCache(SEARCH_CACHE_SIZE)
+
 # Models
 class Product(BaseModel):
     product_id: str
@@ -48,6 +588,14 @@ class ProductSearch(BaseModel):
     category: Optional[str] = None
     min_price: Optional[float] = None
     max_price: Optional[float] = None
+    min_stock: Optional[int] = None
+    # "tokens" ranks index matches; "substring" is the old unranked case-insensitive substring match
+    mode: Literal["tokens", "substring"] = "tokens"
+    # Result paging, order and projection, as for GET /products
+    sort: Optional[str] = None
+    limit: Optional[int] = None
+    cursor: Optional[str] = None
+    fields: Optional[List[str]] = None
 
 # Initialize sample products
 def init_sample_products():
@@ -165,8 +713,8 @@ def init_sample_products():
         },
     ]
     
-    for product_data in sample_products:
-        products_db.append({
+    add_products([
+        {
             "product_id": product_data["product_id"],
             "name": product_data["name"],
             "brand": product_data["brand"],
@@ -175,7 +723,83 @@ def init_sample_products():
             "description": product_data["description"],
             "stock": product_data["stock"],
             "image_url": f"https://via.placeholder.com/300?text={product_data['name'].replace(' ', '+')}"
-        })
+        }
+        for product_data in sample_products
+    ])
+
+# Catalog changes go through these so the indexes stay in step. The cache
+# is invalidated once the change is complete: a search that ran during it
+# was computed under the old version, so its results are never served.
+def add_product(product: dict):
+    try:
+        products_db.append(product)
+        catalog.add(product)
+        if columnar is not None:
+            columnar.add(product)
+        search_index.add(product)
+    finally:
+        search_cache.invalidate()
+
+def add_products(products: List[dict]):
+    try:
+        products_db.extend(products)
+        catalog.extend(products)
+        if columnar is not None:
+            columnar.extend(products)
+        for product in products:
+            search_index.add(product)
+    finally:
+        search_cache.invalidate()
+
+def remove_product(product_id: str) -> bool:
+    product = catalog.remove(product_id)
+    if product is None:
+        return False
+    try:
+        products_db.remove(product)
+        if columnar is not None:
+            columnar.remove(product_id)
+        search_index.remove(product_id)
+    finally:
+        search_cache.invalidate()
+    return True
+
+# Catalog listings: without a limit every product is returned; fields limits
+# each product to the named fields
+PRODUCT_FIELDS = ("product_id", "name", "brand", "category", "price", "description", "stock", "image_url")
+MAX_PAGE_SIZE = 500
+
+def page_response(products: List[dict], limit: Optional[int], cursor: Optional[str], fields) -> JSONResponse:
+    """
+    One page of an ordered result list as a JSON array, with X-Total-Count
+    and, if there are more results, X-Next-Cursor to pass back as cursor.
+    The products are already valid, so they are not validated again.
+    """
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    offset = 0
+    if cursor is not None:
+        try:
+            offset = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if offset < 0:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+    if fields:
+        unknown = [field for field in fields if field not in PRODUCT_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    
+    end = len(products) if limit is None else min(len(products), offset + limit)
+    page = products[offset:end]
+    if fields:
+        page = [{field: p[field] for field in fields} for p in page]
+    headers = {"X-Total-Count": str(len(products))}
+    if end < len(products):
+        headers["X-Next-Cursor"] = str(end)
+    return JSONResponse(content=page, headers=headers)
 
 # Routes
 @app.get("/")
@@ -183,53 +807,102 @@ def read_root():
     return {"message": "Shopping App API", "status": "running"}
 
 @app.get("/products", response_model=List[Product])
-def get_all_products():
-    """Get all products"""
-    return products_db
+def get_all_products(limit: Optional[int] = None, cursor: Optional[str] = None, sort: Optional[str] = None, fields: Optional[str] = None):
+    """
+    Get all products
+    
+    sort by price, name or stock ("-price" for descending); limit and the
+    X-Next-Cursor header page through them; fields=product_id,name,price
+    returns only those fields.
+    """
+    return page_response(ordered_search(ProductSearch(), sort), limit, cursor, fields)
 
 @app.get("/products/{product_id}", response_model=Product)
 def get_product(product_id: str):
     """Get a specific product by ID"""
-    for product in products_db:
-        if product["product_id"] == product_id:
-            return product
+    product = catalog.get(product_id)
+    if product is not None:
+        return product
     raise HTTPException(status_code=404, detail="Product not found")
 
-@app.post("/products/search", response_model=List[Product])
-def search_products(search: ProductSearch):
-    """Search products based on criteria"""
-    print(f"🔍 Product search: query='{search.query}', brand={search.brand}, category={search.category}")
-    results = products_db.copy()
+def normalize_search(search: ProductSearch) -> tuple:
+    """
+    Canonical (mode, query, brand, category, min_price, max_price, min_stock):
+    searches that must return the same products get the same tuple
+    """
+    mode = search.mode
+    typed = (search.query or "").lower().strip()
+    tokens = sorted(set(tokenize(typed)))
+    if mode == "tokens" and tokens:
+        # Token matching ignores case, punctuation, word order and repeats
+        query = " ".join(tokens)
+    else:
+        # Also a token query of only punctuation: it has no words to look up
+        mode, query = "substring", typed
+    brand = (search.brand or "").strip().casefold() or None
+    category = (search.category or "").strip().casefold() or None
+    min_price = float(search.min_price) if search.min_price is not None else None
+    max_price = float(search.max_price) if search.max_price is not None else None
+    return mode, query, brand, category, min_price, max_price, search.min_stock
+
+def ordered_search(search: ProductSearch, sort: Optional[str]) -> List[dict]:
+    """
+    Every product matching search, in relevance or catalog order, or
+    sorted by a SORT_KEYS field ("-field" for descending). Results are
+    cached until the catalog changes.
+    """
+    field = sort[1:] if sort and sort.startswith("-") else sort
+    if field is not None and field not in SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(SORT_KEYS)}, optionally prefixed with -")
+    key = normalize_search(search)
+    results = search_cache.get(key + (sort,))
+    if results is not None:
+        return results
     
-    # Filter by query (search in name, description, and brand - case insensitive, partial match)
-    if search.query:
-        query_lower = search.query.lower().strip()
-        results = [
-            p for p in results
-            if query_lower in p["name"].lower() 
-            or query_lower in p["description"].lower()
-            or query_lower in p["brand"].lower()
-            or query_lower in p["category"].lower()
+    version = search_cache.version
+    mode, query, brand, category, min_price, max_price, min_stock = key
+    ranked_ids = None
+    if query and mode == "tokens":
+        ranked_ids = search_index.search(query)
+    elif query and mode == "substring":
+        # Search in name, description, brand and category - case insensitive, partial match
+        ranked_ids = [
+            p["product_id"] for p in products_db
+            if query in p["name"].lower()
+            or query in p["description"].lower()
+            or query in p["brand"].lower()
+            or query in p["category"].lower()
         ]
     
-    # Filter by brand
-    if search.brand:
-        results = [p for p in results if p["brand"].lower() == search.brand.lower()]
-    
-    # Filter by category
-    if search.category:
-        results = [p for p in results if p["category"].lower() == search.category.lower()]
-    
-    # Filter by price range
-    if search.min_price is not None:
-        results = [p for p in results if p["price"] >= search.min_price]
-    
-    if search.max_price is not None:
-        results = [p for p in results if p["price"] <= search.max_price]
-    
-    print(f"✅ Found {len(results)} products")
+    engine = columnar if columnar is not None else catalog
+    results = engine.select(ranked_ids, brand, category, min_price, max_price, min_stock)
+    if field is not None:
+        results = catalog.order(results, field, descending=sort.startswith("-"))
+    search_cache.put(key + (sort,), version, results)
     return results
 
+@app.post("/products/search", response_model=List[Product])
+def search_products(search: ProductSearch):
+    """
+    Search products based on criteria
+    
+    The query matches products containing every query word, or a word
+    starting with it, in the name, description, brand or category; a
+    query word of three or more characters also matches words containing
+    it ("phone" finds "smartphone"). The best matches come first. A query
+    with no words (only punctuation) is matched as typed.
+    mode="substring" instead keeps products whose fields contain the query
+    as typed, in catalog order.
+    sort, limit, cursor and fields work as for GET /products. Results are
+    cached until the catalog changes; see /search/stats.
+    """
+    return page_response(ordered_search(search, search.sort), search.limit, search.cursor, search.fields)
+
+@app.get("/search/stats")
+def get_search_stats():
+    """Search result cache counters"""
+    return search_cache.stats()
+
 @app.get("/brands")
 def get_brands():
     """Get all available brands"""
@@ -243,20 +916,27 @@ def get_categories():
     return {"categories": sorted(categories)}
 
 @app.get("/products/brand/{brand_name}", response_model=List[Product])
-def get_products_by_brand(brand_name: str):
-    """Get all products from a specific brand"""
-    results = [p for p in products_db if p["brand"].lower() == brand_name.lower()]
+def get_products_by_brand(brand_name: str, limit: Optional[int] = None, cursor: Optional[str] = None,
+                          sort: Optional[str] = None, fields: Optional[str] = None):
+    """Get all products from a specific brand; paging, sort and fields as for GET /products"""
+    results = ordered_search(ProductSearch(brand=brand_name), sort)
     if not results:
         raise HTTPException(status_code=404, detail="Brand not found or has no products")
-    return results
+    return page_response(results, limit, cursor, fields)
 
 @app.get("/products/category/{category_name}", response_model=List[Product])
-def get_products_by_category(category_name: str):
-    """Get all products from a specific category"""
-    results = [p for p in products_db if p["category"].lower() == category_name.lower()]
+def get_products_by_category(category_name: str, limit: Optional[int] = None, cursor: Optional[str] = None,
+                             sort: Optional[str] = None, fields: Optional[str] = None):
+    """Get all products from a specific category; paging, sort and fields as for GET /products"""
+    results = ordered_search(ProductSearch(category=category_name), sort)
     if not results:
         raise HTTPException(status_code=404, detail="Category not found or has no products")
-    return results
+    return page_response(results, limit, cursor, fields)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Latency histograms in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/store-account")
 def get_store_account():